@@ -0,0 +1,428 @@
+import fcntl
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+import numpy as np
+from logger import logger
+
+from perfrunner.helpers.stores import query_columns, sort_keys, to_float
+
+
+class ColumnWriter(object):
+
+    """Append-only writer of raw little-endian columns. Each column is a flat
+    file which can be opened with numpy.memmap without loading the whole
+    series into memory.
+
+    In 'ab' mode several processes may append to the same columns: every
+    append must be done within locked() after sync(), so that rows and
+    columns added by other writers are taken into account."""
+
+    TS_DTYPE = '<i8'
+    DTYPE = '<f8'
+
+    def __init__(self, path, mode='wb'):
+        """Mode 'ab' reopens existing columns for appending."""
+        self.path = path
+        self.mode = mode
+        self.rows = 0
+        self.columns = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.ts_file = open(os.path.join(path, 'timestamps.i8'), mode)
+        self.files = {}
+        self.lock_file = None
+        if mode == 'ab':
+            self.lock_file = open(os.path.join(path, 'lock'), 'a')
+            with self.locked():
+                self.sync()
+
+    @contextmanager
+    def locked(self):
+        """Hold exclusive lock of the database (across processes)."""
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def sync(self):
+        """Catch up with other writers: open columns they added and pad
+        columns which are shorter than timestamps (e.g. created by another
+        writer or left by interrupted append) with NaN."""
+        meta_fname = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_fname):
+            with open(meta_fname) as fh:
+                for field, fname in json.load(fh)['columns'].items():
+                    if field not in self.columns:
+                        self.columns[field] = fname
+        for field, fname in self.columns.items():
+            if field not in self.files:
+                self.files[field] = open(os.path.join(self.path, fname),
+                                         self.mode)
+
+        self.rows = _count_rows(self.path, 'timestamps.i8', self.TS_DTYPE)
+        for field, fh in self.files.items():
+            missing = self.rows - _count_rows(self.path, self.columns[field],
+                                              self.DTYPE)
+            if missing > 0:
+                np.full(missing, np.nan, dtype=self.DTYPE).tofile(fh)
+                fh.flush()
+
+    @staticmethod
+    def _fname(field):
+        return re.sub(r'[^\w.\-]', '_', field) + '.f8'
+
+    def _open_column(self, field):
+        fname = self._fname(field)
+        while fname in self.columns.values():
+            fname = '_' + fname
+        self.columns[field] = fname
+        fh = open(os.path.join(self.path, fname), self.mode)
+        np.full(self.rows, np.nan, dtype=self.DTYPE).tofile(fh)  # backfill
+        self.files[field] = fh
+        self._save_meta()
+        return fh
+
+    @classmethod
+    def _flatten(cls, doc, prefix=''):
+        """Nested documents (e.g. gateload stats) are flattened so that
+        seriesly pointers like /gateload/ops/... become column names."""
+        flat = {}
+        for key, value in doc.items():
+            key = prefix + key
+            if isinstance(value, dict):
+                flat.update(cls._flatten(value, prefix=key + '/'))
+            else:
+                flat[key] = value
+        return flat
+
+    def append(self, page):
+        keys, timestamps = sort_keys(page)
+        self.append_docs(timestamps, [page[k] for k in keys])
+
+    def append_docs(self, timestamps, docs):
+        """Append documents with given timestamps (ms)."""
+        np.asarray(timestamps, dtype=self.TS_DTYPE).tofile(self.ts_file)
+
+        docs = [self._flatten(doc) for doc in docs]
+        fields = set()
+        for doc in docs:
+            fields.update(doc)
+        for field in fields:
+            if field not in self.files:
+                self._open_column(field)
+        for field, fh in self.files.items():
+            values = [to_float(doc.get(field)) for doc in docs]
+            np.asarray(values, dtype=self.DTYPE).tofile(fh)
+
+        self.rows += len(docs)
+
+    def flush(self):
+        """Make appended rows visible to readers. The timestamp file is
+        flushed last, so readers never see rows with incomplete columns."""
+        for fh in self.files.values():
+            fh.flush()
+        self.ts_file.flush()
+
+    def _save_meta(self):
+        """Replace metadata atomically, so that concurrent readers never see
+        a partially written file."""
+        meta = {'rows': self.rows, 'timestamps': 'timestamps.i8',
+                'ts_dtype': self.TS_DTYPE, 'dtype': self.DTYPE,
+                'columns': self.columns}
+        fname = os.path.join(self.path, 'meta.json')
+        tmp_fname = '{}.{}'.format(fname, os.getpid())
+        with open(tmp_fname, 'w') as fh:
+            json.dump(meta, fh, indent=4, sort_keys=True)
+        os.rename(tmp_fname, fname)
+
+    @property
+    def open_files(self):
+        return len(self.files) + (2 if self.lock_file else 1)
+
+    def close(self):
+        if self.lock_file is None:
+            self._save_meta()
+        else:
+            with self.locked():
+                self.sync()  # Don't drop columns added by other writers
+                self._save_meta()
+            self.lock_file.close()
+        self.ts_file.close()
+        for fh in self.files.values():
+            fh.close()
+
+
+def _count_rows(path, fname, dtype):
+    return os.path.getsize(os.path.join(path, fname)) // np.dtype(dtype).itemsize
+
+
+def read_columns(path):
+    """Open archived database as memory-mapped arrays. Return timestamps (ms)
+    and dictionary of columns.
+
+    Columns may still be appended to (see LocalSeriesly), so the number of
+    rows is derived from the size of the shortest file."""
+    with open(os.path.join(path, 'meta.json')) as fh:
+        meta = json.load(fh)
+    rows = min([_count_rows(path, meta['timestamps'], meta['ts_dtype'])] + [
+        _count_rows(path, fname, meta['dtype'])
+        for fname in meta['columns'].values()
+    ])
+
+    def _memmap(fname, dtype):
+        if not rows:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(path, fname), dtype=dtype, mode='r',
+                         shape=(rows, ))
+
+    timestamps = _memmap(meta['timestamps'], meta['ts_dtype'])
+    columns = {field: _memmap(fname, meta['dtype'])
+               for field, fname in meta['columns'].items()}
+    return timestamps, columns
+
+
+class SnapshotArchiver(object):
+
+    """Pulls every collector database of given cluster for a snapshot window
+    and stores it as column files in the run directory:
+
+        snapshots/<snapshot>/manifest.json
+        snapshots/<snapshot>/<db>/meta.json
+        snapshots/<snapshot>/<db>/timestamps.i8
+        snapshots/<snapshot>/<db>/<metric>.f8
+    """
+
+    ROOT = 'snapshots'
+
+    MAX_CONCURRENCY = 8
+
+    def __init__(self, seriesly, root=ROOT):
+        self.seriesly = seriesly
+        self.root = root
+
+    def _archive_db(self, path, db, params):
+        writer = ColumnWriter(os.path.join(path, db))
+        try:
+            for page in self.seriesly[db].iter_all(params):
+                writer.append(page)
+        finally:
+            writer.close()
+        return db, writer.rows
+
+    def archive(self, snapshot, cluster, ts_from, ts_to, **meta):
+        """Archive databases of cluster in [ts_from, ts_to] window (ms).
+        Extra keyword arguments are saved in the manifest."""
+        path = os.path.join(self.root, snapshot)
+        params = {'from': ts_from, 'to': ts_to}
+        dbs = [db for db in self.seriesly.list_dbs() if cluster in db]
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        logger.info('Archiving {} databases to {}'.format(len(dbs), path))
+        pool = ThreadPool(self.MAX_CONCURRENCY)
+        try:
+            rows = dict(pool.map(
+                lambda db: self._archive_db(path, db, params), dbs
+            ))
+        finally:
+            pool.close()
+
+        manifest = dict(meta, snapshot=snapshot, cluster=cluster,
+                        dbs=rows, **{'from': ts_from, 'to': ts_to})
+        with open(os.path.join(path, 'manifest.json'), 'w') as fh:
+            json.dump(manifest, fh, indent=4, sort_keys=True)
+        return path
+
+
+class ArchiveDatabase(object):
+
+    """Read-only view of an archived database with the same query interface
+    as seriesly database."""
+
+    PAGE_SIZE = 10000
+
+    def __init__(self, path):
+        self.timestamps, self.columns = read_columns(path)
+
+    def query(self, params):
+        return query_columns(self.timestamps, self.columns, params)
+
+    def _window(self, params):
+        params = params or {}
+        lo, hi = 0, self.timestamps.size
+        if params.get('from') is not None:
+            lo = np.searchsorted(self.timestamps, int(params['from']))
+        if params.get('to') is not None:
+            hi = np.searchsorted(self.timestamps, int(params['to']),
+                                 side='right')
+        return lo, hi
+
+    def iter_series(self, field, params=None, page_size=PAGE_SIZE):
+        column = self.columns.get(field)
+        if column is None:
+            return
+        lo, hi = self._window(params)
+        for offset in range(lo, hi, page_size):
+            end = min(offset + page_size, hi)
+            yield (np.asarray(self.timestamps[offset:end]),
+                   np.asarray(column[offset:end]))
+
+    def iter_all(self, params=None, page_size=PAGE_SIZE):
+        lo, hi = self._window(params)
+        for offset in range(lo, hi, page_size):
+            end = min(offset + page_size, hi)
+            keys = np.datetime_as_string(
+                self.timestamps[offset:end].astype('datetime64[ms]')
+            )
+            page = {'{}Z'.format(key): {} for key in keys}
+            for field, column in self.columns.items():
+                for key, value in zip(keys, column[offset:end]):
+                    if not np.isnan(value):
+                        page['{}Z'.format(key)][field] = float(value)
+            yield page
+
+    def get_all(self):
+        page = {}
+        for _page in self.iter_all():
+            page.update(_page)
+        return page
+
+
+class ArchiveSeriesly(object):
+
+    """Local data source which behaves like seriesly but serves databases from
+    snapshot archives created by SnapshotArchiver."""
+
+    def __init__(self, paths):
+        self.dbs = {}
+        for path in paths:
+            for db in os.listdir(path):
+                if os.path.isdir(os.path.join(path, db)):
+                    self.dbs[db] = os.path.join(path, db)
+
+    def list_dbs(self):
+        return sorted(self.dbs)
+
+    def __getitem__(self, db):
+        if db not in self.dbs:
+            raise KeyError('Database not found in archive: {}'.format(db))
+        return ArchiveDatabase(self.dbs[db])
+
+
+class LocalDatabase(ArchiveDatabase):
+
+    """Database of LocalSeriesly. Columns are memory-mapped on first read, so
+    every instance is a consistent view of the data appended so far.
+    Timestamps are normally appended in order, otherwise they are sorted in
+    memory (time index) and columns are reordered accordingly."""
+
+    def __init__(self, path, local):
+        self.path = path
+        self.local = local
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            if os.path.exists(os.path.join(self.path, 'meta.json')):
+                timestamps, columns = read_columns(self.path)
+            else:
+                timestamps, columns = np.empty(0, dtype=np.int64), {}
+            if np.any(np.diff(timestamps) < 0):
+                order = np.argsort(timestamps, kind='mergesort')
+                timestamps = timestamps[order]
+                columns = {f: c[order] for f, c in columns.items()}
+            self._data = timestamps, columns
+        return self._data
+
+    @property
+    def timestamps(self):
+        return self._load()[0]
+
+    @property
+    def columns(self):
+        return self._load()[1]
+
+    def append(self, data, timestamp=None):
+        """Store a document with given (ms) or current timestamp."""
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        self.append_docs([timestamp], [data])
+
+    def append_docs(self, timestamps, docs):
+        """Store a batch of documents with given timestamps (ms) at once."""
+        self.local.append_docs(self.path, [int(ts) for ts in timestamps],
+                               docs)
+
+
+class LocalSeriesly(object):
+
+    """Embedded replacement of seriesly for isolated environments and tests.
+    Every database is a directory of append-only columns (the same format as
+    in snapshot archives). Appends are serialized by a file lock per
+    database, so several processes may write to the same database, and
+    documents can be queried at the same time from other processes.
+
+    Writers of recently used databases are kept open. Once they hold more
+    than max_open_files file descriptors, least recently used writers are
+    closed."""
+
+    ROOT = 'stats'
+
+    MAX_OPEN_FILES = 512
+
+    def __init__(self, root=ROOT, max_open_files=MAX_OPEN_FILES):
+        self.root = root
+        self.max_open_files = max_open_files
+        self.writers = OrderedDict()
+        self.lock = Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def create_db(self, db):
+        path = os.path.join(self.root, db)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def list_dbs(self):
+        return sorted(db for db in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, db)))
+
+    def __getitem__(self, db):
+        return LocalDatabase(os.path.join(self.root, db), self)
+
+    def _get_writer(self, path):
+        writer = self.writers.pop(path, None)
+        if writer is None:
+            writer = ColumnWriter(path, mode='ab')
+        self.writers[path] = writer  # The most recently used
+        return writer
+
+    def _evict(self):
+        open_files = sum(w.open_files for w in self.writers.values())
+        while open_files > self.max_open_files and len(self.writers) > 1:
+            _, writer = self.writers.popitem(last=False)
+            open_files -= writer.open_files
+            writer.close()
+
+    def append_docs(self, path, timestamps, docs):
+        with self.lock:
+            writer = self._get_writer(path)
+            with writer.locked():
+                writer.sync()
+                writer.append_docs(timestamps, docs)
+                writer.flush()
+            self._evict()
+
+    def close(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = OrderedDict()
@@ -0,0 +1,78 @@
+import numpy as np
+
+from perfrunner.helpers.histograms import HdrHistogram
+
+
+class BlockBootstrap(object):
+
+    """Non-overlapping block bootstrap of time-ordered samples.
+
+    Consecutive samples are correlated (e.g. latency spikes during flusher
+    activity), so the series is split into blocks which are resampled as a
+    whole. All resamples are evaluated at once: each resample is a vector of
+    multinomial block weights, so that
+
+        resampled sums    = weights x block sums
+        resampled counts  = weights x block histograms
+
+    where block histograms only keep non-empty HdrHistogram buckets. Cost
+    doesn't depend on number of samples once blocks are built.
+    """
+
+    RESAMPLES = 1000
+    MAX_BLOCKS = 500
+    CONFIDENCE = 0.95
+
+    def __init__(self, values, resamples=RESAMPLES, max_blocks=MAX_BLOCKS,
+                 seed=None):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not values.size:
+            raise ValueError('Cannot bootstrap empty series')
+        self.size = values.size
+
+        # Blocks of at least n^(1/3) samples, fewer blocks for long series
+        block_size = max(int(np.ceil(self.size ** (1 / 3.0))),
+                         int(np.ceil(float(self.size) / max_blocks)), 1)
+        blocks = np.arange(self.size) // block_size
+        num_blocks = blocks[-1] + 1
+
+        self.block_sums = np.bincount(blocks, weights=values,
+                                      minlength=num_blocks)
+        self.block_counts = np.bincount(blocks, minlength=num_blocks)
+
+        self.histogram = HdrHistogram()
+        units = np.clip(np.rint(values / self.histogram.unit),
+                        0, self.histogram.max_units).astype(np.int64)
+        buckets, columns = np.unique(self.histogram._index(units),
+                                     return_inverse=True)
+        self.bucket_values = self.histogram._value(buckets) * \
+            self.histogram.unit
+        self.block_histograms = np.bincount(
+            blocks * buckets.size + columns,
+            minlength=num_blocks * buckets.size,
+        ).reshape(num_blocks, buckets.size)
+
+        random = np.random.RandomState(seed)
+        self.weights = random.multinomial(
+            num_blocks, [1.0 / num_blocks] * num_blocks, size=resamples
+        ).astype(np.float64)
+
+    def _interval(self, estimates, confidence):
+        tail = 100 * (1 - confidence) / 2
+        low, high = np.percentile(estimates, [tail, 100 - tail])
+        return float(low), float(high)
+
+    def mean(self, confidence=CONFIDENCE):
+        """Return confidence interval of the mean."""
+        estimates = self.weights.dot(self.block_sums) / \
+            self.weights.dot(self.block_counts)
+        return self._interval(estimates, confidence)
+
+    def percentile(self, percentile, confidence=CONFIDENCE):
+        """Return confidence interval of given (nearest-rank) percentile."""
+        counts = np.cumsum(self.weights.dot(self.block_histograms), axis=1)
+        ranks = np.maximum(np.ceil(percentile / 100.0 * counts[:, -1]), 1)
+        positions = (counts < ranks[:, np.newaxis]).sum(axis=1)
+        positions = np.minimum(positions, self.bucket_values.size - 1)
+        return self._interval(self.bucket_values[positions], confidence)
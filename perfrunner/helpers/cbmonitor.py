@@ -1,8 +1,11 @@
-from calendar import timegm
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
 from copy import copy
 from datetime import datetime
-from multiprocessing import Process
+from multiprocessing import Event, Process, Queue, TimeoutError
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
 
 import requests
 from cbagent.collectors import (NSServer, PS, TypePerf, IO, Net, ActiveTasks,
@@ -11,9 +14,18 @@ from cbagent.collectors import (NSServer, PS, TypePerf, IO, Net, ActiveTasks,
                                 N1QLStats, ObserveLatency, XdcrLag)
 from cbagent.metadata_client import MetadataClient
 from decorator import decorator
+from fabric.api import execute, hide, parallel, run
+from fabric.api import settings as env_settings
 from logger import logger
 
-from perfrunner.helpers.misc import target_hash, uhex
+from perfrunner.helpers.archive import LocalSeriesly, SnapshotArchiver
+from perfrunner.helpers.misc import (pretty_dict, target_hash, timestamp_ms,
+                                     uhex)
+from perfrunner.helpers.scheduler import (AdaptiveSampling,
+                                          CollectorScheduler, collector_names,
+                                          run_collectors,
+                                          run_threaded_collector)
+from perfrunner.helpers.stores import RemoteSeriesly
 
 
 @decorator
@@ -28,24 +40,99 @@ def with_stats(method, *args):
             test.cbagent.update_metadata()
         test.cbagent.start()
 
-    from_ts = datetime.utcnow()
+    test.cbagent.sub_phases = []
+    from_ts = timestamp_ms()
     method(*args)
-    to_ts = datetime.utcnow()
+    to_ts = timestamp_ms()
 
     if stats_enabled:
         test.cbagent.stop()
 
         test.cbagent.add_snapshot(method.__name__, from_ts, to_ts)
+        for sub_phase, sub_from_ts, sub_to_ts in test.cbagent.sub_phases:
+            logger.info('Sub-phase {} of {}: {:.3f} sec'.format(
+                sub_phase, method.__name__, (sub_to_ts - sub_from_ts) / 1e3))
+            test.cbagent.add_snapshot(
+                '{}_{}'.format(method.__name__, sub_phase),
+                sub_from_ts, sub_to_ts,
+            )
         test.snapshots = test.cbagent.snapshots
+        test.metric_helper.invalidate_cache()
+
+        if test.cbagent.client_cores:
+            test.metric_helper.check_client_saturation(
+                method.__name__, test.cbagent.client_cores, from_ts, to_ts
+            )
 
-    from_ts = timegm(from_ts.timetuple()) * 1000  # -> ms
-    to_ts = timegm(to_ts.timetuple()) * 1000  # -> ms
     return from_ts, to_ts
 
 
+class ClientCPU(PS):
+
+    """Host-wide CPU usage of worker hosts, derived from /proc/stat. Like in
+    atop, usage is summed over all cores (e.g. 200% means two busy cores),
+    so that it can be compared against the number of cores. Unlike PS, it
+    accounts for all processes on the host, not only the largest one."""
+
+    def __init__(self, settings):
+        super(ClientCPU, self).__init__(settings)
+        self.hosts = settings.hostnames
+        self.credentials = settings.ssh_username, settings.ssh_password
+        self.ticks = {}
+
+    @staticmethod
+    def _read_stat():
+        return run('grep "^cpu" /proc/stat', pty=False)
+
+    def _get_usage(self, host, stat):
+        lines = stat.splitlines()
+        # user, nice, system, idle, iowait, irq, softirq, steal
+        ticks = [int(t) for t in lines[0].split()[1:9]]
+        total = sum(ticks)
+        busy = total - ticks[3] - ticks[4]
+        cores = len(lines) - 1  # Aggregate line is followed by per-core ones
+
+        prev_busy, prev_total = self.ticks.get(host, (None, None))
+        self.ticks[host] = busy, total
+        if prev_total is None or total <= prev_total:
+            return
+        return 100.0 * cores * (busy - prev_busy) / (total - prev_total)
+
+    def sample(self):
+        user, password = self.credentials
+        with env_settings(hide('everything'), user=user, password=password):
+            stats = execute(parallel(self._read_stat), hosts=self.hosts)
+        for host, stat in stats.items():
+            try:
+                cpu = self._get_usage(host, stat)
+            except (IndexError, ValueError):
+                logger.warn('Cannot parse /proc/stat of {}'.format(host))
+                continue
+            if cpu is not None:
+                self.update_metric_metadata(['cpu'], server=host)
+                self.store.append({'cpu': cpu}, cluster=self.cluster,
+                                  server=host, collector=self.COLLECTOR)
+
+
 class CbAgent(object):
 
+    # Client-side measurements which are sensitive to sharing CPU with other
+    # collectors, they always run in dedicated processes.
+    LATENCY_COLLECTORS = (SpringLatency, SpringQueryLatency,
+                          SpringN1QLQueryLatency, ObserveLatency, XdcrLag)
+
+    # Collectors which run their own sampling threads (collect() never
+    # returns), each one runs in a dedicated process as is.
+    THREADED_COLLECTORS = (ObserveLatency, XdcrLag)
+
+    STOP_TIMEOUT = CollectorScheduler.DRAIN_TIMEOUT + 5
+
+    MAX_CONCURRENCY = 8
+
+    REPORT_TIMEOUT = 1800  # Total wait for reports at teardown, sec
+
     def __init__(self, test):
+        self.build = test.build
         self.clusters = OrderedDict()
         for cluster_name, servers in test.cluster_spec.yield_clusters():
             cluster = '{}_{}_{}'.format(cluster_name,
@@ -73,6 +160,22 @@ class CbAgent(object):
                 test.remote.gateways if test.remote else None,
         })()
         self.lat_interval = test.test_config.stats_settings.lat_interval
+        self.collector_processes = \
+            test.test_config.stats_settings.collector_processes
+        self.buffered_writes = test.test_config.stats_settings.buffered_writes
+        self.adaptive_sampling = \
+            test.test_config.stats_settings.adaptive_sampling
+        self.sample_budget = test.test_config.stats_settings.sample_budget
+        self.long_lived = test.test_config.stats_settings.long_lived_collectors
+        self.client_stats = test.test_config.stats_settings.client_stats
+        self.client_cores = {}
+        self.adaptive = None
+        self.sampling_lag_threshold = \
+            test.test_config.stats_settings.sampling_lag_threshold
+        if test.test_config.stats_settings.store == 'local':
+            self.local_store = test.test_config.stats_settings.store_path
+        else:
+            self.local_store = None
         if test.cluster_spec.ssh_credentials:
             self.settings.ssh_username, self.settings.ssh_password = \
                 test.cluster_spec.ssh_credentials
@@ -82,9 +185,22 @@ class CbAgent(object):
 
         self.settings.new_n1ql_queries = test.test_config.access_settings.n1ql_queries
 
+        if test.test_config.stats_settings.archive:
+            self.archiver = SnapshotArchiver(self.get_seriesly())
+        else:
+            self.archiver = None
+
         self.collectors = []
         self.processes = []
+        self.threaded_processes = []
         self.snapshots = []
+        self.sub_phases = []
+        self.stop_event = None
+        self.running = None
+        self.reports = []
+        self._report_pool = None
+        self.results = None
+        self.collector_stats = {}
 
     def prepare_collectors(self, test,
                            latency=False, secondary_stats=False,
@@ -102,6 +218,8 @@ class CbAgent(object):
             self.prepare_iostat(clusters, test)
         elif test.remote.os == 'Cygwin':
             self.prepare_tp(clusters)
+        if self.client_stats and test.test_config.test_case.use_workers:
+            self.prepare_clients(clusters[0], test)
         if latency:
             self.prepare_latency(clusters, test)
         if query_latency:
@@ -150,6 +268,22 @@ class CbAgent(object):
             ps_collector = PS(settings)
             self.collectors.append(ps_collector)
 
+    def prepare_clients(self, cluster, test):
+        """Resource usage of worker hosts which run workload generators.
+        Their samples belong to the first cluster."""
+        workers = test.cluster_spec.workers
+        if not workers or test.remote is None:
+            return
+        self.client_cores = test.remote.detect_client_cores()
+        settings = copy(self.settings)
+        settings.cluster = cluster
+        settings.master_node = self.clusters[cluster]
+        settings.hostnames = tuple(workers)
+        settings.ssh_username, settings.ssh_password = \
+            test.cluster_spec.client_credentials
+        self.collectors.append(ClientCPU(settings))
+        self.collectors.append(Net(settings))
+
     def prepare_tp(self, clusters):
         for cluster in clusters:
             settings = copy(self.settings)
@@ -259,30 +393,243 @@ class CbAgent(object):
             settings.master_node = self.clusters[cluster]
             self.collectors.append(ActiveTasks(settings))
 
+    def get_seriesly(self):
+        if self.local_store:
+            return LocalSeriesly(self.local_store)
+        return RemoteSeriesly(self.settings.seriesly_host)
+
     def update_metadata(self):
+        if self.local_store:  # No cbmonitor
+            return
         for collector in self.collectors:
             collector.update_metadata()
 
+    def _get_collector_groups(self):
+        """Return groups of collectors driven by CollectorScheduler. By
+        default every collector runs in its own process. If
+        collector_processes is set, stats collectors are spread over that
+        many processes."""
+        collectors = [c for c in self.collectors
+                      if not isinstance(c, self.THREADED_COLLECTORS)]
+        if not self.collector_processes:
+            return [[c] for c in collectors]
+        latency = [c for c in collectors
+                   if isinstance(c, self.LATENCY_COLLECTORS)]
+        stats = [c for c in collectors if c not in latency]
+        return [[c] for c in latency] + [
+            stats[i::self.collector_processes]
+            for i in range(min(self.collector_processes, len(stats)))
+        ]
+
     def start(self):
-        self.processes = [Process(target=c.collect) for c in self.collectors]
+        """Start collector processes, each one running CollectorScheduler
+        (except for THREADED_COLLECTORS, see start_threaded()). Long-lived
+        collectors which are already running are resumed instead.
+
+        With adaptive sampling all processes share the same AdaptiveSampling
+        policy. Samples are always buffered then, so that they keep true
+        timestamps regardless of the sampling rate. Latency collectors keep
+        their fixed rate."""
+        if self.processes:
+            self.running.set()
+            self.start_threaded()
+            return
+
+        self.stop_event = Event()
+        self.running = Event()
+        self.running.set()
+        self.results = Queue()
+        seriesly = None
+        if self.adaptive_sampling:
+            self.adaptive = AdaptiveSampling(self.sample_budget)
+        if self.local_store or self.buffered_writes or self.adaptive:
+            seriesly = self.get_seriesly()
+        groups = self._get_collector_groups()
+        names = iter(collector_names(sum(groups, [])))
+        for collectors in groups:
+            fixed_rate = all(isinstance(c, self.LATENCY_COLLECTORS)
+                             for c in collectors)
+            self.processes.append(
+                Process(target=run_collectors,
+                        args=(collectors, self.stop_event, self.results,
+                              seriesly, self.adaptive, fixed_rate,
+                              self.running, [next(names) for _ in collectors]))
+            )
         map(lambda p: p.start(), self.processes)
+        self.start_threaded()
+
+    def start_threaded(self):
+        """Run collectors with their own sampling threads as before: one
+        process per collector, which is terminated by stop_threaded()."""
+        seriesly = self.get_seriesly() if self.local_store else None
+        self.threaded_processes = [
+            Process(target=run_threaded_collector, args=(c, seriesly))
+            for c in self.collectors
+            if isinstance(c, self.THREADED_COLLECTORS)
+        ]
+        map(lambda p: p.start(), self.threaded_processes)
+
+    def stop_threaded(self):
+        map(lambda p: p.terminate(), self.threaded_processes)
+        map(lambda p: p.join(), self.threaded_processes)
+        self.threaded_processes = []
+
+    def boost(self):
+        """Sample more often for a while, e.g. when rebalance starts. No-op
+        unless adaptive sampling is enabled."""
+        if self.adaptive is not None:
+            logger.info('Boosting sampling rate')
+            self.adaptive.boost()
 
     def stop(self):
-        map(lambda p: p.terminate(), self.processes)
+        """Pause collectors, so that samples in progress are completed and
+        stored. Unless collectors are long-lived, their processes exit then.
+        THREADED_COLLECTORS cannot be paused, they are terminated and started
+        again by the next phase.
+
+        Dropped samples, samples skipped due to sample budget and sampling lag
+        above sampling_lag_threshold (as a fraction of collector interval) are
+        reported."""
+        self.running.clear()
+        self.stop_threaded()
+
+        self.collector_stats = {}
+        deadline = time.time() + self.STOP_TIMEOUT
+        for _ in self.processes:
+            try:
+                timeout = max(deadline - time.time(), 0)
+                self.collector_stats.update(self.results.get(timeout=timeout))
+            except Empty:
+                break
+        if not self.long_lived:
+            self.shutdown()
+
+        dropped = {name: stats['dropped']
+                   for name, stats in self.collector_stats.items()
+                   if stats['dropped']}
+        if dropped:
+            logger.warn('Dropped samples: {}'.format(pretty_dict(dropped)))
+        over_budget = {name: stats['over_budget']
+                       for name, stats in self.collector_stats.items()
+                       if stats['over_budget']}
+        if over_budget:
+            logger.info('Samples skipped due to sample budget: {}'.format(
+                pretty_dict(over_budget)))
+        lagging = {
+            name: round(stats['max_lag'], 3)
+            for name, stats in self.collector_stats.items()
+            if stats['max_lag'] >
+            self.sampling_lag_threshold * stats['interval']
+        }
+        if lagging:
+            logger.warn('Sampling lag exceeded {:.0%} of interval, max lag '
+                        '(sec): {}'.format(self.sampling_lag_threshold,
+                                           pretty_dict(lagging)))
         return datetime.utcnow()
 
+    def shutdown(self):
+        """Stop collector processes. Processes which don't exit in time are
+        terminated."""
+        self.stop_threaded()
+        if not self.processes:
+            return
+        self.stop_event.set()
+        deadline = time.time() + self.STOP_TIMEOUT
+        for p in self.processes:
+            p.join(max(deadline - time.time(), 0))
+            if p.is_alive():
+                logger.warn('Collector process {} did not stop in time, '
+                            'terminating'.format(p.pid))
+                p.terminate()
+        self.processes = []
+
+    @property
+    def report_pool(self):
+        if self._report_pool is None:
+            self._report_pool = ThreadPool(self.MAX_CONCURRENCY)
+        return self._report_pool
+
+    @staticmethod
+    def _get_report(url):
+        t0 = time.time()
+        r = requests.get(url=url)
+        return r.status_code, time.time() - t0
+
     def trigger_reports(self, snapshot):
+        """Request cbmonitor reports asynchronously, they may take minutes
+        to render. Responses are checked by collect_reports()."""
         for report_type in ('html', 'get_corr_matrix'):
             url = 'http://{}/reports/{}/?snapshot={}'.format(
                 self.settings.cbmonitor_host_port, report_type, snapshot)
             logger.info(url)
-            requests.get(url=url)
+            self.reports.append(
+                (url, self.report_pool.apply_async(self._get_report, (url, )))
+            )
+
+    def collect_reports(self, timeout=REPORT_TIMEOUT):
+        """Wait for pending reports (up to timeout seconds in total)."""
+        deadline = time.time() + timeout
+        reports, self.reports = self.reports, []
+        for url, result in reports:
+            try:
+                status, elapsed = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                logger.warn('Report is not ready: {}'.format(url))
+            except Exception, e:
+                logger.warn('Failed to get report {}: {}'.format(url, e))
+            else:
+                logger.info('Report {} ({}) took {:.1f} sec'.format(
+                    url, status, elapsed))
+        if self._report_pool is not None:
+            self._report_pool.terminate()
+            self._report_pool = None
+
+    @contextmanager
+    def sub_phase(self, name):
+        """Mark a step of the current with_stats phase (e.g. every rebalance),
+        which becomes a separate snapshot once the phase is over. Steps are
+        numbered: rebalance_1, rebalance_2, etc."""
+        number = 1 + sum(1 for sub_phase, _, _ in self.sub_phases
+                         if sub_phase.rsplit('_', 1)[0] == name)
+        ts_from = timestamp_ms()
+        try:
+            yield
+        finally:
+            self.sub_phases.append(('{}_{}'.format(name, number),
+                                    ts_from, timestamp_ms()))
+
+    def _register_snapshot(self, cluster, snapshot, ts_from, ts_to):
+        settings = copy(self.settings)
+        settings.cluster = cluster
+        md_client = MetadataClient(settings)
+        md_client.add_snapshot(snapshot,
+                               datetime.utcfromtimestamp(ts_from / 1e3),
+                               datetime.utcfromtimestamp(ts_to / 1e3))
 
     def add_snapshot(self, phase, ts_from, ts_to):
-        for i, cluster in enumerate(self.clusters, start=1):
-            snapshot = '{}_{}'.format(cluster, phase)
-            self.settings.cluster = cluster
-            md_client = MetadataClient(self.settings)
-            md_client.add_snapshot(snapshot, ts_from, ts_to)
-            self.snapshots.append(snapshot)
-            self.trigger_reports(snapshot)
+        """Add snapshot of [ts_from, ts_to] window (ms) for every cluster.
+        Clusters are registered (and archived) concurrently, reports are
+        triggered asynchronously."""
+        snapshots = ['{}_{}'.format(cluster, phase)
+                     for cluster in self.clusters]
+        self.snapshots += snapshots
+        pool = ThreadPool(len(self.clusters))
+        try:
+            if not self.local_store:
+                pool.map(
+                    lambda args: self._register_snapshot(*args,
+                                                         ts_from=ts_from,
+                                                         ts_to=ts_to),
+                    zip(self.clusters, snapshots)
+                )
+                map(self.trigger_reports, snapshots)
+            if self.archiver:
+                pool.map(
+                    lambda args: self.archiver.archive(*args, ts_from=ts_from,
+                                                       ts_to=ts_to,
+                                                       phase=phase,
+                                                       build=self.build),
+                    zip(snapshots, self.clusters)
+                )
+        finally:
+            pool.close()
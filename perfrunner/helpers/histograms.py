@@ -0,0 +1,150 @@
+import numpy as np
+
+
+class HdrHistogram(object):
+
+    """Streaming log-linear histogram in the spirit of HdrHistogram.
+
+    Values are converted to integer multiples of `unit` and counted in a fixed
+    array of buckets. Every power of two is split into linear sub-buckets, so
+    memory is constant (it only depends on `highest` and `digits`) while the
+    relative error of any reported percentile is bounded:
+
+        |estimate - exact| <= max(unit, exact * 10 ** -digits)
+
+    where `exact` is the nearest-rank percentile of recorded samples. Values
+    above `highest` are clamped to the last bucket (max is still exact).
+
+    Histograms with identical layout can be merged, e.g. across buckets or
+    seriesly pages.
+    """
+
+    UNIT = 0.001  # ms -> us resolution
+    HIGHEST = 3600 * 1000  # 1 hour in ms
+    DIGITS = 3
+
+    def __init__(self, unit=UNIT, highest=HIGHEST, digits=DIGITS):
+        self.unit = unit
+        self.highest = highest
+        self.digits = digits
+
+        # Smallest power of two with enough linear sub-buckets for precision
+        self.sub_bucket_bits = int(np.ceil(np.log2(2 * 10 ** digits)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+
+        self.max_units = int(np.ceil(float(highest) / unit))
+        num_buckets = self._index(np.array([self.max_units]))[0] + 1
+        self.counts = np.zeros(num_buckets, dtype=np.int64)
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, units):
+        """Map integer values (in units) to bucket indexes."""
+        _, exponent = np.frexp(np.maximum(units, 1))  # exact for ints < 2^53
+        shift = np.maximum(exponent - self.sub_bucket_bits, 0)
+        sub_bucket = units >> shift
+        return np.where(
+            shift == 0,
+            units,
+            self.sub_bucket_count + (shift - 1) * self.sub_bucket_half +
+            sub_bucket - self.sub_bucket_half,
+        )
+
+    def _value(self, index):
+        """Return the median equivalent value of given bucket (in units)."""
+        index = np.asarray(index)
+        shift = np.where(
+            index < self.sub_bucket_count,
+            0,
+            (index - self.sub_bucket_count) // self.sub_bucket_half + 1,
+        )
+        sub_bucket = np.where(
+            index < self.sub_bucket_count,
+            index,
+            (index - self.sub_bucket_count) % self.sub_bucket_half +
+            self.sub_bucket_half,
+        )
+        lowest = sub_bucket.astype(np.int64) << shift
+        width = np.int64(1) << shift
+        return lowest + (width - 1) / 2.0
+
+    def record_values(self, values, weight=1):
+        """Record values, each of them is counted `weight` times."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return
+
+        units = np.clip(np.rint(values / self.unit), 0, self.max_units)
+        indexes = self._index(units.astype(np.int64))
+        self.counts += weight * np.bincount(indexes,
+                                            minlength=self.counts.size)
+
+        self.count += weight * values.size
+        self.total += weight * values.sum()
+        v_min, v_max = values.min(), values.max()
+        self.min = v_min if self.min is None else min(self.min, v_min)
+        self.max = v_max if self.max is None else max(self.max, v_max)
+
+    def record_value(self, value):
+        self.record_values([value])
+
+    def record_corrected_values(self, values, expected_interval, weight=1):
+        """Record values with correction for coordinated omission.
+
+        A client which issues requests every `expected_interval` doesn't send
+        anything while it waits for a slow response, so requests which should
+        have been sent in the meantime are never measured. Like in
+        HdrHistogram, every value above the interval is back-filled with
+        values - interval, values - 2 * interval, ... down to the interval.
+        Back-filled values are counted once: `weight` only applies to the
+        measured ones (e.g. when every sample represents many requests).
+        """
+        self.record_values(values, weight)
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        values = values[values >= 2 * expected_interval]
+        missing = (values // expected_interval).astype(np.int64) - 1
+        if not missing.sum():
+            return
+        offsets = np.arange(missing.sum()) - \
+            np.repeat(np.cumsum(missing) - missing, missing) + 1
+        self.record_values(np.repeat(values, missing) -
+                           offsets * expected_interval)
+
+    def merge(self, other):
+        if (self.unit, self.highest, self.digits) != \
+                (other.unit, other.highest, other.digits):
+            raise ValueError('Cannot merge histograms with different layout')
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        for func, attr in ((min, 'min'), (max, 'max')):
+            values = [v for v in (getattr(self, attr), getattr(other, attr))
+                      if v is not None]
+            setattr(self, attr, func(values) if values else None)
+        return self
+
+    def percentile(self, percentile):
+        if not self.count:
+            return float('nan')
+        if percentile >= 100:
+            return self.max
+        rank = max(1, int(np.ceil(percentile / 100.0 * self.count)))
+        index = np.searchsorted(np.cumsum(self.counts), rank)
+        value = float(self._value(index)) * self.unit
+        return min(max(value, self.min), self.max)
+
+    def percentiles(self, percentiles):
+        return [self.percentile(p) for p in percentiles]
+
+    @property
+    def mean(self):
+        if not self.count:
+            return float('nan')
+        return self.total / self.count
@@ -1,20 +1,130 @@
 import numpy as np
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
 from logger import logger
-from seriesly import Seriesly
+
+from perfrunner.helpers.archive import LocalSeriesly
+from perfrunner.helpers.bootstrap import BlockBootstrap
+from perfrunner.helpers.histograms import HdrHistogram
+from perfrunner.helpers.misc import pretty_dict
+from perfrunner.helpers.stores import RemoteSeriesly, sort_keys, to_float
+from perfrunner.helpers.timeseries import (Resampler, align, change_points,
+                                           counter_rate, fit_segments,
+                                           parse_series, rolling_mean_std,
+                                           steady_state)
+
+
+Metric = namedtuple('Metric', ('collector', 'field', 'reducer', 'scope',
+                               'aggregate', 'unit'))
+
+# Declarative metric definitions:
+#   collector - database prefix, e.g. ns_server or atop
+#   field, reducer - seriesly pointer and reducer over the time window
+#   scope - set of databases: bucket, first_bucket, server, initial_server
+#   aggregate - how values are combined across databases: sum, avg, max, min
+#   unit - unit of result, see UNITS
+METRICS = {
+    'avg_xdc_ops':
+        Metric('ns_server', 'xdc_ops', 'avg', 'bucket', 'sum', None),
+    'avg_ep_num_ops_set_meta':
+        Metric('ns_server', 'ep_num_ops_set_meta', 'avg', 'bucket', 'sum',
+               None),
+    'avg_replication_changes_left':
+        Metric('ns_server', 'replication_changes_left', 'avg', 'bucket', 'sum',
+               None),
+    'avg_disk_write_queue':
+        Metric('ns_server', 'disk_write_queue', 'avg', 'bucket', 'sum', 'K'),
+    'avg_ep_bg_fetched':
+        Metric('ns_server', 'ep_bg_fetched', 'avg', 'bucket', 'sum', None),
+    'avg_avg_bg_wait_time':
+        Metric('ns_server', 'avg_bg_wait_time', 'avg', 'bucket', 'avg', 'ms'),
+    'avg_couch_views_ops':
+        Metric('ns_server', 'couch_views_ops', 'avg', 'bucket', 'sum', None),
+    'avg_cpu_utilization_rate':
+        Metric('ns_server', 'cpu_utilization_rate', 'avg', 'first_bucket',
+               'sum', None),
+    'max_couch_views_actual_disk_size':
+        Metric('ns_server', 'couch_views_actual_disk_size', 'max', 'bucket',
+               'sum', 'GB'),
+    'min_couch_views_actual_disk_size':
+        Metric('ns_server', 'couch_views_actual_disk_size', 'min', 'bucket',
+               'sum', 'GB'),
+    'max_couch_docs_actual_disk_size':
+        Metric('ns_server', 'couch_docs_actual_disk_size', 'max', 'bucket',
+               'sum', 'GB'),
+    'min_couch_docs_actual_disk_size':
+        Metric('ns_server', 'couch_docs_actual_disk_size', 'min', 'bucket',
+               'sum', 'GB'),
+    'avg_cmd_set':
+        Metric('ns_server', 'cmd_set', 'avg', 'bucket', 'sum', None),
+    'avg_data_wbps':
+        Metric('iostat', 'data_wbps', 'avg', 'server', 'sum', None),
+    'max_mem_used':
+        Metric('ns_server', 'mem_used', 'max', 'bucket', 'max', 'MB'),
+    'max_beam.smp_rss':
+        Metric('atop', 'beam.smp_rss', 'max', 'server', 'max', 'MB'),
+    'max_memcached_rss':
+        Metric('atop', 'memcached_rss', 'max', 'initial_server', 'max', 'MB'),
+    'avg_memcached_rss':
+        Metric('atop', 'memcached_rss', 'avg', 'initial_server', 'avg', 'MB'),
+}
+
+UNITS = {  # Divisors of raw values
+    None: 1,
+    'K': 10 ** 3,
+    'ms': 10 ** 3,  # us -> ms
+    'MB': 1024 ** 2,
+    'GB': 1024 ** 3,
+}
+
+AGGREGATES = {
+    'sum': np.nansum,
+    'avg': np.nanmean,
+    'max': np.nanmax,
+    'min': np.nanmin,
+}
 
 
 class MetricHelper(object):
 
+    MAX_CONCURRENCY = 16
+
+    LATENCY_PERCENTILES = (50, 90, 95, 99, 99.9, 99.99)
+
+    PROCESSES = ('beam.smp', 'memcached')
+
+    REBALANCE_IMPACT = {  # field: (collector, aggregate, larger_is_better)
+        'ops': ('ns_server', 'sum', True),
+        'latency_get': ('spring_latency', 'avg', False),
+        'latency_set': ('spring_latency', 'avg', False),
+        'latency_query': ('spring_query_latency', 'avg', False),
+        'xdcr_lag': ('xdcr_lag', 'avg', False),
+    }
+
     def __init__(self, test):
-        self.seriesly = Seriesly(
-            test.test_config.stats_settings.seriesly['host'])
+        stats_settings = test.test_config.stats_settings
+        if stats_settings.store == 'local':
+            self.seriesly = LocalSeriesly(stats_settings.store_path)
+        else:
+            self.seriesly = RemoteSeriesly(stats_settings.seriesly['host'],
+                                           pool_size=self.MAX_CONCURRENCY)
         self.test_config = test.test_config
         self.metric_title = test.test_config.test_case.metric_title
         self.cluster_spec = test.cluster_spec
         self.cluster_names = test.cbagent.clusters.keys()
         self.build = test.build
         self.master_node = test.master_node
+        self.annotations = {}
+        self.client_saturation = {}
+        self._cache = {}
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.MAX_CONCURRENCY)
+        return self._pool
 
     @staticmethod
     def _get_query_params(metric, from_ts=None, to_ts=None):
@@ -31,6 +141,355 @@ class MetricHelper(object):
             params.update({'from': from_ts, 'to': to_ts})
         return params
 
+    def _query(self, db, params):
+        """Send seriesly query unless the same query was already sent since
+        the last snapshot."""
+        key = (db, ) + tuple(
+            tuple(v) if isinstance(v, list) else v
+            for v in (params.get(p) for p in ('ptr', 'reducer', 'group',
+                                              'from', 'to'))
+        )
+        if key not in self._cache:
+            self._cache[key] = self.seriesly[db].query(params)
+        return self._cache[key]
+
+    def _query_all(self, dbs, params):
+        """Send the same query to all databases in parallel. Results are
+        returned in the same order as databases."""
+        return self.pool.map(lambda db: self._query(db, params), dbs)
+
+    def _get_bucket_dbs(self, collector, cluster=None):
+        cluster = cluster or self.cluster_names[0]
+        return ['{}{}{}'.format(collector, cluster, bucket)
+                for bucket in self.test_config.buckets]
+
+    def _get_server_dbs(self, collector, initial_nodes=False):
+        dbs = []
+        for i, (cluster_name, servers) in \
+                enumerate(self.cluster_spec.yield_clusters()):
+            cluster = filter(lambda name: name.startswith(cluster_name),
+                             self.cluster_names)[0]
+            if initial_nodes:
+                servers = servers[:self.test_config.cluster.initial_nodes[i]]
+            for server in servers:
+                hostname = server.split(':')[0].replace('.', '')
+                dbs.append('{}{}{}'.format(collector, cluster, hostname))
+        return dbs
+
+    def invalidate_cache(self):
+        """Results of open-ended queries are no longer valid once new
+        samples are collected."""
+        self._cache.clear()
+
+    def _get_default_metric(self, metric=None):
+        """Name of metric which values are posted under by default (see
+        SFReporter.post_to_sf). Methods which annotate values accept metric
+        name if it's posted under a different one."""
+        if metric is not None:
+            return metric
+        return '{}_{}'.format(self.test_config.name, self.cluster_spec.name)
+
+    def _find_steady_state(self, dbs, ptrs):
+        """Detect steady state of given series (ramp-up after workers start
+        and tail after they stop are excluded). With several databases or
+        pointers the intersection of windows is used. Return trimmed
+        boundaries or None."""
+        stats_settings = self.test_config.stats_settings
+        windows, first, last = [], [], []
+        for ptr in ptrs:
+            query_params = {'ptr': ptr, 'reducer': 'avg', 'group': 1000}
+            for data in self._query_all(dbs, query_params):
+                if not data:
+                    continue
+                timestamps, values = parse_series(data)
+                first.append(timestamps[0])
+                last.append(timestamps[-1])
+                window = steady_state(
+                    timestamps, values,
+                    window=stats_settings.steady_state_window,
+                    threshold=stats_settings.steady_state_threshold
+                )
+                if window:
+                    windows.append(window)
+
+        if not windows:
+            logger.warn('Steady state not found: {}'.format(ptrs))
+            return
+        ts_from = max(w[0] for w in windows)
+        ts_to = min(w[1] for w in windows)
+        if ts_from >= ts_to:
+            logger.warn('Steady state windows do not overlap: {}'.format(ptrs))
+            return
+
+        steady = {'from': ts_from, 'to': ts_to,
+                  'trimmed_head': (ts_from - min(first)) / 1000.0,
+                  'trimmed_tail': (max(last) - ts_to) / 1000.0}
+        logger.info('Steady state of {}: {}'.format(ptrs, pretty_dict(steady)))
+        return steady
+
+    def _annotate_steady_state(self, metric, steady):
+        if steady:
+            self.annotations.setdefault(metric, {})['steady_state'] = steady
+
+    def _get_steady_state(self, dbs, ptr, metric):
+        """Return query params which restrict calculations to steady state
+        of given series, or empty dict. Trimmed boundaries are saved as
+        metric annotations."""
+        if not self.test_config.stats_settings.steady_state:
+            return {}
+        steady = self._find_steady_state(dbs, [ptr])
+        if not steady:
+            return {}
+        self._annotate_steady_state(metric, steady)
+        return {'from': steady['from'], 'to': steady['to']}
+
+    def _get_expected_interval(self, collector):
+        """Return expected interval (ms) between requests of a single worker
+        which runs at the target throughput and the number of requests
+        represented by each latency sample. None means that coordinated
+        omission cannot be corrected."""
+        stats_settings = self.test_config.stats_settings
+        access_settings = self.test_config.access_settings
+        if not stats_settings.latency_correction:
+            return
+        if collector == 'spring_latency':
+            throughput = access_settings.throughput
+            workers = access_settings.workers
+        elif collector == 'spring_query_latency':
+            throughput = access_settings.query_throughput
+            workers = access_settings.query_workers
+        else:
+            return
+        if throughput == float('inf') or not workers:
+            logger.warn('Cannot correct {} without throughput target'
+                        .format(collector))
+            return
+
+        expected_interval = 1000.0 * workers / throughput
+        weight = int(round(stats_settings.lat_interval * 1000.0 /
+                           expected_interval))
+        return expected_interval, max(weight, 1)
+
+    def _get_counter_rate(self, db, ptr, period=1000):
+        """Return timestamps and per-second rates of counter resampled to
+        given period (ms). Counter is sampled as max value per second."""
+        query_params = {'ptr': ptr, 'reducer': 'max', 'group': 1000}
+        data = self._query(db, query_params)
+        return counter_rate(*parse_series(data), period=period)
+
+    def _get_latency(self, collector, cluster=None):
+        """Read every database of latency collector once and stream all
+        latency fields into histograms merged across buckets. If enabled,
+        histograms corrected for coordinated omission are built as well.
+        Time-ordered samples are kept only if confidence intervals are
+        enabled.
+
+        Results are cached until the next snapshot, so that any number of
+        percentiles and operations costs a single pass over the data."""
+        key = ('latency', collector, cluster)
+        if key in self._cache:
+            return self._cache[key]
+
+        stats_settings = self.test_config.stats_settings
+        dbs = self._get_bucket_dbs(collector, cluster)
+
+        fields = set()
+        for db in dbs:
+            for page in self.seriesly[db].iter_all(page_size=1):
+                fields.update(f for f in page.values()[0]
+                              if f.startswith('latency_'))
+                break
+        fields = sorted(fields)
+
+        params, steady = None, None
+        if stats_settings.steady_state and fields:
+            steady = self._find_steady_state(
+                dbs, ['/{}'.format(f) for f in fields]
+            )
+            if steady:
+                params = {'from': steady['from'], 'to': steady['to']}
+
+        correction = self._get_expected_interval(collector)
+        corrected_fields = fields if correction else []
+
+        def _read_db(db):
+            histograms = {f: HdrHistogram() for f in fields}
+            corrected = {f: HdrHistogram() for f in corrected_fields}
+            samples = {f: [] for f in fields}
+            for page in self.seriesly[db].iter_all(params):
+                docs = [page[ts] for ts in sort_keys(page)[0]]
+                for field in fields:
+                    values = np.array([to_float(doc.get(field))
+                                       for doc in docs])
+                    histograms[field].record_values(values)
+                    if correction:
+                        corrected[field].record_corrected_values(values,
+                                                                 *correction)
+                    if stats_settings.confidence_intervals:
+                        samples[field].append(values)
+            return histograms, corrected, samples
+
+        histograms = {f: HdrHistogram() for f in fields}
+        corrected = {f: HdrHistogram() for f in corrected_fields}
+        samples = {f: [] for f in fields}
+        for db_histograms, db_corrected, db_samples in \
+                self.pool.map(_read_db, dbs):
+            for field in fields:
+                histograms[field].merge(db_histograms[field])
+                samples[field] += db_samples[field]
+            for field in corrected_fields:
+                corrected[field].merge(db_corrected[field])
+        samples = {f: np.concatenate(s) for f, s in samples.items() if s}
+
+        self._cache[key] = histograms, corrected, samples, steady
+        return self._cache[key]
+
+    def _annotate_ci(self, metric, interval):
+        confidence = BlockBootstrap.CONFIDENCE
+        annotation = {'low': round(interval[0], 2),
+                      'high': round(interval[1], 2),
+                      'confidence': confidence}
+        logger.info('{:.0%} confidence interval of {}: [{}, {}]'.format(
+            confidence, metric, annotation['low'], annotation['high']))
+        self.annotations.setdefault(metric, {})['ci'] = annotation
+
+    def _get_percentile(self, collector, field, percentile, metric,
+                        corrected=False):
+        """Return percentile of all samples of given field. Confidence
+        interval is estimated by block bootstrap if enabled."""
+        histograms, corrected_histograms, samples, steady = \
+            self._get_latency(collector)
+        self._annotate_steady_state(metric, steady)
+        if corrected:
+            histograms, samples = corrected_histograms, {}
+        if field not in histograms:
+            logger.warn('No data: {}, {}'.format(collector, field))
+            return float('nan')
+
+        if field in samples and samples[field].size:
+            bootstrap = BlockBootstrap(samples[field])
+            self._annotate_ci(metric, bootstrap.percentile(percentile))
+        return histograms[field].percentile(percentile)
+
+    def _annotate_mean_ci(self, dbs, query_params, metric, scale=1):
+        """Estimate confidence interval of the sum of averages across
+        databases. Per-second averages are summed across databases (only
+        timestamps present everywhere are used) and the mean of totals is
+        bootstrapped."""
+        if not self.test_config.stats_settings.confidence_intervals:
+            return
+
+        query_params = dict(query_params, group=1000)
+        timestamps, values = [], []
+        for data in self._query_all(dbs, query_params):
+            for ts, value in data.items():
+                if value[0] is not None:
+                    timestamps.append(int(ts))
+                    values.append(value[0])
+        if not values:
+            return
+
+        timestamps, inverse, counts = np.unique(timestamps,
+                                                return_inverse=True,
+                                                return_counts=True)
+        totals = np.bincount(inverse, weights=values)[counts == len(dbs)]
+        if totals.size:
+            low, high = BlockBootstrap(totals).mean()
+            self._annotate_ci(metric, (low * scale, high * scale))
+
+    def _get_metric_dbs(self, name, cluster=None):
+        definition = METRICS[name]
+        if definition.scope == 'bucket':
+            return self._get_bucket_dbs(definition.collector, cluster)
+        if definition.scope == 'first_bucket':
+            return self._get_bucket_dbs(definition.collector, cluster)[:1]
+        if definition.scope == 'server':
+            return self._get_server_dbs(definition.collector)
+        if definition.scope == 'initial_server':
+            return self._get_server_dbs(definition.collector,
+                                        initial_nodes=True)
+        raise ValueError('Unknown scope: {}'.format(definition.scope))
+
+    def _get_db_metrics(self, db, collector, params):
+        """Calculate all registered metrics of collector for given database
+        in a single query. Results are cached, so that every database is
+        read once per snapshot (and time window).
+
+        With adaptive sampling collectors sample more often during eventful
+        periods, so samples are first reduced per stats interval and then
+        across intervals, otherwise averages would be biased towards those
+        periods."""
+        pairs = sorted({(m.field, m.reducer) for m in METRICS.values()
+                        if m.collector == collector})
+        stats_settings = self.test_config.stats_settings
+        if stats_settings.adaptive_sampling:
+            group = stats_settings.interval * 1000
+        else:
+            group = 1000000000000
+        query_params = dict(params,
+                            ptr=['/{}'.format(field) for field, _ in pairs],
+                            reducer=[reducer for _, reducer in pairs],
+                            group=group)
+        data = self._query(db, query_params)
+        if not data:
+            values = [None] * len(pairs)
+        elif len(data) == 1:
+            values = data.values()[0]
+        else:
+            groups = np.array([[to_float(v) for v in row]
+                               for row in data.values()])
+            values = [
+                AGGREGATES[reducer](groups[:, column])
+                for column, (_, reducer) in enumerate(pairs)
+            ]
+        return dict(zip(pairs, values))
+
+    def _get_metric_values(self, name, cluster=None, params=None):
+        """Return raw values of registered metric for every database of its
+        scope. Missing values are NaN."""
+        definition = METRICS[name]
+        dbs = self._get_metric_dbs(name, cluster)
+        db_metrics = self.pool.map(
+            lambda db: self._get_db_metrics(db, definition.collector,
+                                            params or {}),
+            dbs
+        )
+        return np.array([
+            to_float(metrics[(definition.field, definition.reducer)])
+            for metrics in db_metrics
+        ])
+
+    def _calc_metric(self, name, cluster=None, metric=None, aggregate=None,
+                     scale=1, params=None):
+        """Calculate registered metric: values of all databases are
+        aggregated and converted to metric unit, then multiplied by scale.
+
+        If metric name is given, calculation is restricted to steady state
+        and averages are annotated with confidence intervals (if enabled)."""
+        definition = METRICS[name]
+        aggregate = aggregate or definition.aggregate
+        scale = float(scale) / UNITS[definition.unit]
+        dbs = self._get_metric_dbs(name, cluster)
+        ptr = '/{}'.format(definition.field)
+
+        params = dict(params or {})
+        if metric:
+            params.update(self._get_steady_state(dbs, ptr, metric))
+
+        values = self._get_metric_values(name, cluster, params)
+        if np.isnan(values).all():
+            logger.warn('No data: {}'.format(name))
+            return float('nan')
+        value = AGGREGATES[aggregate](values) * scale
+
+        if metric and definition.reducer == 'avg' and \
+                aggregate in ('sum', 'avg'):
+            if aggregate == 'avg':
+                scale /= len(dbs)
+            self._annotate_mean_ci(dbs, dict(params, ptr=ptr, reducer='avg'),
+                                   metric, scale)
+        return value
+
     def _get_metric_info(self, title, larger_is_better=False, level='Basic'):
         return {'title': title,
                 'cluster': self.cluster_spec.name,
@@ -42,13 +501,9 @@ class MetricHelper(object):
                                              self.cluster_spec.name)
         title = 'Avg. XDCR ops/sec, {}'.format(self.metric_title)
         metric_info = self._get_metric_info(title, larger_is_better=True)
-        query_params = self._get_query_params('avg_xdc_ops')
 
-        xdcr_ops = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[1], bucket)
-            data = self.seriesly[db].query(query_params)
-            xdcr_ops += data.values()[0][0]
+        xdcr_ops = self._calc_metric('avg_xdc_ops', self.cluster_names[1],
+                                     metric=metric)
         xdcr_ops = round(xdcr_ops, 1)
 
         return xdcr_ops, metric, metric_info
@@ -58,13 +513,9 @@ class MetricHelper(object):
                                                  self.cluster_spec.name)
         title = 'Avg. XDCR rate (items/sec), {}'.format(self.metric_title)
         metric_info = self._get_metric_info(title, larger_is_better=True)
-        query_params = self._get_query_params('avg_ep_num_ops_set_meta')
 
-        set_meta_ops = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[1], bucket)
-            data = self.seriesly[db].query(query_params)
-            set_meta_ops += data.values()[0][0]
+        set_meta_ops = self._calc_metric('avg_ep_num_ops_set_meta',
+                                         self.cluster_names[1], metric=metric)
         set_meta_ops = round(set_meta_ops, 1)
 
         return set_meta_ops, metric, metric_info
@@ -79,12 +530,13 @@ class MetricHelper(object):
         query_params = self._get_query_params('avg_xdcr_lag')
         query_params.update({'group': 1000})
 
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = 'xdcr_lag{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            timings = [v[0] for v in data.values()]
-        lag = round(np.percentile(timings, percentile))
+        histogram = HdrHistogram()
+        dbs = self._get_bucket_dbs('xdcr_lag')
+        query_params.update(self._get_steady_state(dbs, query_params['ptr'],
+                                                   metric))
+        for data in self._query_all(dbs, query_params):
+            histogram.record_values([v[0] for v in data.values()])
+        lag = round(histogram.percentile(percentile))
 
         return lag, metric, metric_info
 
@@ -93,14 +545,8 @@ class MetricHelper(object):
                                                       self.cluster_spec.name)
         title = 'Avg. replication queue, {}'.format(self.metric_title)
         metric_info = self._get_metric_info(title)
-        query_params = self._get_query_params('avg_replication_changes_left')
 
-        queues = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            queues += data.values()[0][0]
-        queue = round(queues)
+        queue = round(self._calc_metric('avg_replication_changes_left'))
 
         return queue, metric, metric_info
 
@@ -120,72 +566,56 @@ class MetricHelper(object):
         return round(drain_rate)
 
     def calc_avg_disk_write_queue(self):
-        query_params = self._get_query_params('avg_disk_write_queue')
-
-        disk_write_queue = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            disk_write_queue += data.values()[0][0]
-        disk_write_queue /= self.test_config.cluster.initial_nodes[0]
-
-        return round(disk_write_queue / 10 ** 3)
+        disk_write_queue = self._calc_metric(
+            'avg_disk_write_queue',
+            scale=1.0 / self.test_config.cluster.initial_nodes[0]
+        )
 
-    def calc_avg_ep_bg_fetched(self):
-        query_params = self._get_query_params('avg_ep_bg_fetched')
+        return round(disk_write_queue)
 
-        ep_bg_fetched = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            ep_bg_fetched += data.values()[0][0]
-        ep_bg_fetched /= self.test_config.cluster.initial_nodes[0]
+    def calc_avg_ep_bg_fetched(self, metric=None):
+        ep_bg_fetched = self._calc_metric(
+            'avg_ep_bg_fetched', metric=self._get_default_metric(metric),
+            scale=1.0 / self.test_config.cluster.initial_nodes[0]
+        )
 
         return round(ep_bg_fetched)
 
-    def calc_avg_bg_wait_time(self):
-        query_params = self._get_query_params('avg_avg_bg_wait_time')
-
-        avg_bg_wait_time = []
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            avg_bg_wait_time.append(data.values()[0][0])
-        avg_bg_wait_time = np.mean(avg_bg_wait_time) / 10 ** 3  # us -> ms
+    def calc_avg_bg_wait_time(self, metric=None):
+        avg_bg_wait_time = self._calc_metric(
+            'avg_avg_bg_wait_time', metric=self._get_default_metric(metric)
+        )
 
         return round(avg_bg_wait_time, 1)
 
-    def calc_avg_couch_views_ops(self):
-        query_params = self._get_query_params('avg_couch_views_ops')
-
-        couch_views_ops = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            couch_views_ops += data.values()[0][0]
-
+    def calc_avg_couch_views_ops(self, metric=None):
+        scale = 1.0
         if self.build < '2.5.0':
-            couch_views_ops /= self.test_config.cluster.initial_nodes[0]
+            scale /= self.test_config.cluster.initial_nodes[0]
+
+        couch_views_ops = self._calc_metric(
+            'avg_couch_views_ops', metric=self._get_default_metric(metric),
+            scale=scale
+        )
 
         return round(couch_views_ops)
 
-    def calc_query_latency(self, percentile):
+    def calc_query_latency(self, percentile, corrected=False):
         metric = '{}_{}'.format(self.test_config.name, self.cluster_spec.name)
         title = '{}th percentile query latency (ms), {}'.format(percentile,
                                                                 self.metric_title)
+        if corrected:
+            metric = '{}_corrected'.format(metric)
+            title = 'Corrected {}'.format(title)
         metric_info = self._get_metric_info(title)
 
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = 'spring_query_latency{}{}'.format(self.cluster_names[0],
-                                                   bucket)
-            data = self.seriesly[db].get_all()
-            timings += [value['latency_query'] for value in data.values()]
-        query_latency = np.percentile(timings, percentile)
+        query_latency = self._get_percentile('spring_query_latency',
+                                             'latency_query', percentile,
+                                             metric, corrected)
 
         return round(query_latency), metric, metric_info
 
-    def calc_kv_latency(self, operation, percentile):
+    def calc_kv_latency(self, operation, percentile, corrected=False):
         metric = '{}_{}_{}th_{}'.format(self.test_config.name,
                                         operation,
                                         percentile,
@@ -193,16 +623,15 @@ class MetricHelper(object):
         title = '{}th percentile {} {}'.format(percentile,
                                                operation.upper(),
                                                self.metric_title)
+        if corrected:
+            metric = '{}_corrected'.format(metric)
+            title = 'Corrected {}'.format(title)
         metric_info = self._get_metric_info(title)
 
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = 'spring_latency{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].get_all()
-            timings += [
-                v['latency_{}'.format(operation)] for v in data.values()
-            ]
-        latency = round(np.percentile(timings, percentile), 1)
+        latency = self._get_percentile('spring_latency',
+                                       'latency_{}'.format(operation),
+                                       percentile, metric, corrected)
+        latency = round(latency, 1)
 
         return latency, metric, metric_info
 
@@ -212,15 +641,40 @@ class MetricHelper(object):
         title = '{}th percentile {}'.format(percentile, self.metric_title)
         metric_info = self._get_metric_info(title)
 
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = 'observe{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].get_all()
-            timings += [v['latency_observe'] for v in data.values()]
-        latency = round(np.percentile(timings, percentile))
+        latency = self._get_percentile('observe', 'latency_observe',
+                                       percentile, metric)
+        latency = round(latency)
 
         return latency, metric, metric_info
 
+    def calc_latency_percentiles(self, collector='spring_latency',
+                                 percentiles=LATENCY_PERCENTILES):
+        """Return percentile ladder, max and count of every latency field of
+        given collector, e.g.:
+
+        {'get': {'p50': 0.4, ..., 'p99.99': 9.8, 'max': 21.3, 'count': 3600},
+         'get corrected': {...},
+         'set': {...},
+         'set corrected': {...}}
+
+        Corrected values (coordinated omission) are reported only if
+        latency_correction is enabled. Databases are read once per snapshot,
+        subsequent calls (including calc_kv_latency and friends) are served
+        from memory."""
+        histograms, corrected, _, _ = self._get_latency(collector)
+        histograms = dict(histograms, **{
+            '{} corrected'.format(f): h for f, h in corrected.items()
+        })
+        ladder = OrderedDict()
+        for field, histogram in sorted(histograms.items()):
+            ladder[field.replace('latency_', '')] = OrderedDict(
+                [('p{}'.format(p), round(histogram.percentile(p), 3))
+                 for p in percentiles] +
+                [('max', round(histogram.max or 0, 3)),
+                 ('count', histogram.count)]
+            )
+        return ladder
+
     def calc_cpu_utilization(self):
         metric = '{}_avg_cpu_{}'.format(self.test_config.name,
                                         self.cluster_spec.name)
@@ -228,13 +682,7 @@ class MetricHelper(object):
         title = '{}, {}'.format(title, self.metric_title)
         metric_info = self._get_metric_info(title)
 
-        cluster = self.cluster_names[0]
-        bucket = self.test_config.buckets[0]
-
-        query_params = self._get_query_params('avg_cpu_utilization_rate')
-        db = 'ns_server{}{}'.format(cluster, bucket)
-        data = self.seriesly[db].query(query_params)
-        cpu_utilazion = round(data.values()[0][0])
+        cpu_utilazion = round(self._calc_metric('avg_cpu_utilization_rate'))
 
         return cpu_utilazion, metric, metric_info
 
@@ -251,14 +699,12 @@ class MetricHelper(object):
         title = title.replace(' (min)', '')  # rebalance tests
         metric_info = self._get_metric_info(title, level='Advanced')
 
-        query_params = self._get_query_params('max_couch_views_actual_disk_size',
-                                              from_ts, to_ts)
-
-        disk_size = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-            disk_size += round(data.values()[0][0] / 1024 ** 3, 1)  # -> GB
+        params = {}
+        if from_ts and to_ts:
+            params = {'from': from_ts, 'to': to_ts}
+        disk_size = self._calc_metric('max_couch_views_actual_disk_size',
+                                      params=params)
+        disk_size = round(disk_size, 1)
 
         return disk_size, metric, metric_info
 
@@ -270,17 +716,8 @@ class MetricHelper(object):
                                                self.metric_title)
         metric_info = self._get_metric_info(title)
 
-        query_params = self._get_query_params('max_mem_used')
-
-        mem_used = []
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(query_params)
-
-            mem_used.append(
-                round(data.values()[0][0] / 1024 ** 2)  # -> MB
-            )
-        mem_used = eval(max_min)(mem_used)
+        mem_used = self._calc_metric('max_mem_used', aggregate=max_min)
+        mem_used = round(mem_used)
 
         return mem_used, metric, metric_info
 
@@ -290,18 +727,7 @@ class MetricHelper(object):
         title = 'Max. beam.smp RSS (MB), {}'.format(self.metric_title)
         metric_info = self._get_metric_info(title)
 
-        query_params = self._get_query_params('max_beam.smp_rss')
-
-        max_rss = 0
-        for cluster_name, servers in self.cluster_spec.yield_clusters():
-            cluster = filter(lambda name: name.startswith(cluster_name),
-                             self.cluster_names)[0]
-            for server in servers:
-                hostname = server.split(':')[0].replace('.', '')
-                db = 'atop{}{}'.format(cluster, hostname)  # Legacy
-                data = self.seriesly[db].query(query_params)
-                rss = round(data.values()[0][0] / 1024 ** 2)
-                max_rss = max(max_rss, rss)
+        max_rss = round(self._calc_metric('max_beam.smp_rss'))
 
         return max_rss, metric, metric_info
 
@@ -313,21 +739,7 @@ class MetricHelper(object):
         )
         metric_info = self._get_metric_info(title)
 
-        query_params = self._get_query_params('max_memcached_rss')
-
-        max_rss = 0
-        for (cluster_name, servers), initial_nodes in zip(
-                self.cluster_spec.yield_clusters(),
-                self.test_config.cluster.initial_nodes,
-        ):
-            cluster = filter(lambda name: name.startswith(cluster_name),
-                             self.cluster_names)[0]
-            for server in servers[:initial_nodes]:
-                hostname = server.split(':')[0].replace('.', '')
-                db = 'atop{}{}'.format(cluster, hostname)
-                data = self.seriesly[db].query(query_params)
-                rss = round(data.values()[0][0] / 1024 ** 2)
-                max_rss = max(max_rss, rss)
+        max_rss = round(self._calc_metric('max_memcached_rss'))
 
         return max_rss, metric, metric_info
 
@@ -339,22 +751,8 @@ class MetricHelper(object):
         )
         metric_info = self._get_metric_info(title)
 
-        query_params = self._get_query_params('avg_memcached_rss')
-
-        rss = list()
-        for (cluster_name, servers), initial_nodes in zip(
-                self.cluster_spec.yield_clusters(),
-                self.test_config.cluster.initial_nodes,
-        ):
-            cluster = filter(lambda name: name.startswith(cluster_name),
-                             self.cluster_names)[0]
-            for server in servers[:initial_nodes]:
-                hostname = server.split(':')[0].replace('.', '')
-                db = 'atop{}{}'.format(cluster, hostname)
-                data = self.seriesly[db].query(query_params)
-                rss.append(round(data.values()[0][0] / 1024 ** 2))
+        avg_rss = round(self._calc_metric('avg_memcached_rss'))
 
-        avg_rss = sum(rss) / len(rss)
         return avg_rss, metric, metric_info
 
     def get_indexing_meta(self, value, index_type):
@@ -369,27 +767,13 @@ class MetricHelper(object):
 
     def calc_compaction_speed(self, time_elapsed, bucket=True):
         if bucket:
-            max_query_params = \
-                self._get_query_params('max_couch_docs_actual_disk_size')
-            min_query_params = \
-                self._get_query_params('min_couch_docs_actual_disk_size')
+            metric = 'couch_docs_actual_disk_size'
         else:
-            max_query_params = \
-                self._get_query_params('max_couch_views_actual_disk_size')
-            min_query_params = \
-                self._get_query_params('min_couch_views_actual_disk_size')
-
-        max_diff = 0
-        for bucket in self.test_config.buckets:
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(max_query_params)
-            disk_size_before = data.values()[0][0]
-
-            db = 'ns_server{}{}'.format(self.cluster_names[0], bucket)
-            data = self.seriesly[db].query(min_query_params)
-            disk_size_after = data.values()[0][0]
+            metric = 'couch_views_actual_disk_size'
 
-            max_diff = max(max_diff, disk_size_before - disk_size_after)
+        disk_size_before = self._get_metric_values('max_{}'.format(metric))
+        disk_size_after = self._get_metric_values('min_{}'.format(metric))
+        max_diff = max(0, np.nanmax(disk_size_before - disk_size_after))
 
         diff = max_diff / 1024 ** 2 / time_elapsed  # Mbytes/sec
         return round(diff, 1)
@@ -408,23 +792,351 @@ class MetricHelper(object):
 
         return rebalance_time, metric, metric_info
 
+    def calc_write_amplification(self):
+        """Device bytes written to the data partition (all nodes) divided by
+        logical bytes mutated, i.e. sets/sec multiplied by document size and
+        number of copies, so that replication doesn't count as amplification.
+        """
+        metric = '{}_write_amplification_{}'.format(self.test_config.name,
+                                                    self.cluster_spec.name)
+        title = 'Write amplification, {}'.format(self.metric_title)
+        metric_info = self._get_metric_info(title, level='Advanced')
+
+        copies = 1 + self.test_config.bucket.replica_number
+        logical = self._calc_metric('avg_cmd_set') * \
+            self.test_config.access_settings.size * copies
+        device = self._calc_metric('avg_data_wbps')
+        if not logical or np.isnan(logical):
+            logger.warn('No mutations, cannot calculate write amplification')
+            return float('nan'), metric, metric_info
+
+        return round(device / logical, 2), metric, metric_info
+
+    def calc_space_amplification(self):
+        """Disk size of data files divided by data size (all buckets) over
+        time. Return the peak ratio, average and final ratios are attached
+        as annotations."""
+        metric = '{}_space_amplification_{}'.format(self.test_config.name,
+                                                    self.cluster_spec.name)
+        title = 'Peak space amplification, {}'.format(self.metric_title)
+        metric_info = self._get_metric_info(title, level='Advanced')
+
+        series = []
+        for db in self._get_bucket_dbs('ns_server'):
+            series += self._get_aligned_series(
+                db, ('couch_docs_actual_disk_size', 'couch_docs_data_size')
+            )
+        _, values = align(series)
+        disk_size, data_size = values[0::2].sum(axis=0), \
+            values[1::2].sum(axis=0)
+        valid = data_size > 0
+        if not valid.any():
+            logger.warn('No data size, cannot calculate space amplification')
+            return float('nan'), metric, metric_info
+
+        ratio = disk_size[valid] / data_size[valid]
+        self.annotations.setdefault(metric, {})['space_amplification'] = {
+            'avg': round(ratio.mean(), 2), 'last': round(ratio[-1], 2),
+        }
+        return round(ratio.max(), 2), metric, metric_info
+
+    def _get_impact_series(self, field, params):
+        """Per-interval averages of the field, combined across buckets."""
+        collector, aggregate, _ = self.REBALANCE_IMPACT[field]
+        period = self.test_config.stats_settings.interval * 1000
+        series = self.pool.map(
+            lambda db: self._get_resampled(db, field, period, 'mean',
+                                           params),
+            self._get_bucket_dbs(collector)
+        )
+        timestamps, values = align(series)
+        return timestamps, AGGREGATES[aggregate](values, axis=0)
+
+    def _get_impact(self, timestamps, values, started, finished,
+                    larger_is_better, tolerance):
+        """Compare levels of piecewise constant fit of the series with the
+        pre-rebalance baseline. Return phases (baseline, worst level during
+        rebalance, level at the end), degradation (%) and recovery time (sec)
+        or None if there is no data before, during or after rebalance.
+
+        The series is considered recovered once its degradation doesn't
+        exceed tolerance (fraction of baseline)."""
+        before = timestamps < started
+        after = timestamps > finished
+        during = ~before & ~after
+        if not before.any() or not during.any() or not after.any():
+            return None
+
+        fit = fit_segments(values, change_points(values))
+        baseline = np.median(fit[before])
+        if not baseline:
+            return None
+        sign = 1 if larger_is_better else -1
+        degradation = sign * (baseline - fit) / abs(baseline)
+
+        worst = np.argmax(np.where(during, degradation, -np.inf))
+        degraded = after & (degradation > tolerance)
+        if degraded.any():
+            last = np.flatnonzero(degraded)[-1]
+            if last + 1 < timestamps.size:
+                recovery = (timestamps[last + 1] - finished) / 1000.0
+            else:
+                logger.warn('Not recovered within {} sec after rebalance'
+                            .format((timestamps[-1] - finished) / 1000))
+                recovery = (timestamps[-1] - finished) / 1000.0
+        else:
+            recovery = 0.0
+
+        phases = {'baseline': round(baseline, 1),
+                  'rebalance': round(fit[worst], 1),
+                  'after': round(fit[-1], 1)}
+        return phases, 100 * max(degradation[worst], 0), recovery
+
+    def calc_rebalance_impact(self, fields, started, finished, from_ts=None,
+                              to_ts=None):
+        """Quantify how much given series (see REBALANCE_IMPACT) degraded
+        during rebalance (%) and how long it took to recover (sec) after
+        rebalance finished. Rebalance boundaries are epoch seconds, series
+        are limited to the snapshot window [from_ts, to_ts] (ms).
+
+        Change points split every series into segments with stable level, so
+        that noise doesn't count as degradation or recovery. Levels of phases
+        are reported as annotations. Return (value, metric, metric_info)
+        tuples."""
+        started, finished = int(started * 1000), int(finished * 1000)
+        params = {}
+        if from_ts and to_ts:
+            params = {'from': from_ts, 'to': to_ts}
+        tolerance = self.test_config.rebalance_settings.recovery_tolerance
+        impact = []
+        for field in fields:
+            larger_is_better = self.REBALANCE_IMPACT[field][2]
+            timestamps, values = self._get_impact_series(field, params)
+            result = self._get_impact(timestamps, values, started, finished,
+                                      larger_is_better, tolerance)
+            if result is None:
+                logger.warn('Not enough data to estimate rebalance impact on '
+                            '{}'.format(field))
+                continue
+            phases, degradation, recovery = result
+
+            for name, value, title in (
+                ('degradation', round(degradation, 1),
+                 'Rebalance degradation of {} (%)'),
+                ('recovery', round(recovery, 1),
+                 'Recovery time of {} after rebalance (sec)'),
+            ):
+                metric = '{}_{}_{}_{}'.format(self.test_config.name, field,
+                                              name, self.cluster_spec.name)
+                metric_info = self._get_metric_info(
+                    '{}, {}'.format(title.format(field), self.metric_title),
+                    level='Advanced'
+                )
+                self.annotations.setdefault(metric, {})['phases'] = phases
+                impact.append((value, metric, metric_info))
+        return impact
+
+    def _get_aligned_series(self, db, fields):
+        """Return timestamps and per-interval averages of given fields. Groups
+        are aligned to the stats interval, so that series from different
+        collectors can be joined on time."""
+        group = self.test_config.stats_settings.interval * 1000
+        query_params = {'ptr': ['/{}'.format(field) for field in fields],
+                        'reducer': ['avg'] * len(fields),
+                        'group': group}
+        data = self._query(db, query_params)
+        return [parse_series(data, column=i) for i in range(len(fields))]
+
+    def _get_node_usage(self, cluster, hostname, existing_dbs):
+        """Join ns_server (all buckets), PS and net stats of a single node on
+        time. Return total ops, items, CPU cores, network bytes and RSS bytes
+        accumulated over aligned intervals, or None if there is no data."""
+        sources = [('ns_server{}{}{}'.format(cluster, bucket, hostname),
+                    ('ops', 'curr_items'), ['ops', 'items'])
+                   for bucket in self.test_config.buckets]
+        ps_fields, ps_kinds = [], []
+        for process in self.PROCESSES:
+            ps_fields += ['{}_cpu'.format(process), '{}_rss'.format(process)]
+            ps_kinds += ['cores', 'rss']
+        sources += [
+            ('atop{}{}'.format(cluster, hostname), ps_fields, ps_kinds),
+            ('net{}{}'.format(cluster, hostname),
+             ('in_bytes_per_sec', 'out_bytes_per_sec'), ['net', 'net']),
+        ]
+
+        series, kinds = [], []
+        for db, fields, db_kinds in sources:
+            if db not in existing_dbs:
+                logger.warn('No data: {}'.format(db))
+                continue
+            series += self._get_aligned_series(db, fields)
+            kinds += db_kinds
+        if not series:
+            return
+
+        _, values = align(series)
+        kinds = np.array(kinds)
+        usage = {kind: values[kinds == kind].sum() for kind in set(kinds)}
+        if 'cores' in usage:
+            usage['cores'] /= 100  # %CPU -> cores
+        return usage
+
+    @staticmethod
+    def _get_ratio(usage, numerator, denominator):
+        """Return None if either of inputs is missing, so that missing stats
+        are never reported as perfect or terrible efficiency."""
+        if numerator not in usage or not usage.get(denominator):
+            return
+        return usage[numerator] / usage[denominator]
+
+    def _get_efficiency(self, usage, metric, title, level):
+        efficiency = []
+        for name, numerator, denominator, title_prefix, larger_is_better in (
+            ('ops_per_core_second', 'ops', 'cores',
+             'Ops per CPU core-second', True),
+            ('net_bytes_per_op', 'net', 'ops',
+             'Network bytes per op', False),
+            ('rss_bytes_per_item', 'rss', 'items',
+             'RSS bytes per item', False),
+        ):
+            value = self._get_ratio(usage, numerator, denominator)
+            if value is None:
+                logger.warn('No data: {}'.format(metric.format(name)))
+                continue
+            metric_info = self._get_metric_info(
+                '{}, {}'.format(title_prefix, title), larger_is_better, level
+            )
+            efficiency.append((round(value, 1), metric.format(name),
+                               metric_info))
+        return efficiency
+
+    def calc_efficiency(self):
+        """Return resource efficiency metrics (ops per CPU core-second,
+        network bytes per op and RSS bytes per item) for every cluster and
+        every node as (value, metric, metric_info) tuples.
+
+        ns_server, PS and net series are aligned on time, so ratios are
+        calculated over intervals where all stats are available."""
+        clusters = list(self.cluster_spec.yield_clusters())
+        existing_dbs = set(self.seriesly.list_dbs())
+        efficiency = []
+        for i, (cluster_name, servers) in enumerate(clusters):
+            cluster = filter(lambda name: name.startswith(cluster_name),
+                             self.cluster_names)[0]
+            suffix = self.cluster_spec.name
+            if len(clusters) > 1:
+                suffix = '{}_{}'.format(cluster_name, suffix)
+
+            servers = servers[:self.test_config.cluster.initial_nodes[i]]
+            hostnames = [s.split(':')[0] for s in servers]
+            usages = self.pool.map(
+                lambda h: self._get_node_usage(cluster, h.replace('.', ''),
+                                               existing_dbs),
+                hostnames
+            )
+            nodes = [(hostname, usage)
+                     for hostname, usage in zip(hostnames, usages)
+                     if usage is not None]
+            if not nodes:
+                continue
+            for hostname, usage in nodes:
+                metric = '{}_{{}}_{}_{}'.format(self.test_config.name,
+                                                hostname.replace('.', ''),
+                                                suffix)
+                title = '{}, {}'.format(hostname, self.metric_title)
+                efficiency += self._get_efficiency(usage, metric, title,
+                                                   level='Advanced')
+
+            kinds = set.intersection(*(set(u) for _, u in nodes))
+            usage = {k: sum(u[k] for _, u in nodes) for k in kinds}
+            metric = '{}_{{}}_{}'.format(self.test_config.name, suffix)
+            efficiency += self._get_efficiency(usage, metric,
+                                               self.metric_title,
+                                               level='Basic')
+        return efficiency
+
+    def _get_resampled(self, db, field, period, method, params=None):
+        """Stream raw samples of a single field and resample them onto the
+        grid of given period (ms), see Resampler."""
+        resampler = Resampler(period, method)
+        for timestamps, values in self.seriesly[db].iter_series(field,
+                                                                params):
+            resampler.update(timestamps, values)
+        return resampler.result()
+
+    def get_aligned(self, sources, period=1000, method='linear'):
+        """Resample series of different collectors (pairs of db and field)
+        onto a common grid. Return timestamps and 2-D array of values, one
+        row per source, for timestamps where all series have data."""
+        series = self.pool.map(
+            lambda source: self._get_resampled(*source,
+                                               period=period, method=method),
+            sources
+        )
+        return align(series)
+
+    def calc_correlation(self, x, y, period=1000, method='linear'):
+        """Pearson correlation of two series (pairs of db and field) sampled
+        by different collectors, e.g. latency vs. memcached CPU usage."""
+        _, values = self.get_aligned([x, y], period, method)
+        if values.shape[1] < 2:
+            logger.warn('Not enough data to correlate {} and {}'.format(x, y))
+            return float('nan')
+        return round(np.corrcoef(values)[0, 1], 3)
+
+    def check_client_saturation(self, phase, cores, from_ts, to_ts):
+        """Flag phase if any client host was the bottleneck: host-wide CPU
+        usage (see ClientCPU) relative to the number of cores, averaged over
+        client_saturation_window seconds, exceeded client_cpu_threshold (%).
+        Peak network throughput of clients is reported as well. Results are
+        attached to all benchmarks of the test."""
+        stats_settings = self.test_config.stats_settings
+        period = stats_settings.interval * 1000
+        window = max(stats_settings.client_saturation_window /
+                     stats_settings.interval, 1)
+        params = {'from': from_ts, 'to': to_ts}
+        cluster = self.cluster_names[0]
+
+        clients = {}
+        for host, num_cores in cores.items():
+            hostname = host.split(':')[0].replace('.', '')
+            _, cpu = self._get_resampled('atop{}{}'.format(cluster, hostname),
+                                         'cpu', period, 'mean', params)
+            cpu = cpu[~np.isnan(cpu)] / num_cores
+            if not cpu.size:
+                continue
+            sustained, _ = rolling_mean_std(cpu, min(window, cpu.size))
+            stats = {'cpu': round(sustained.max(), 1)}
+            for field in ('in_bytes_per_sec', 'out_bytes_per_sec'):
+                _, rates = self._get_resampled(
+                    'net{}{}'.format(cluster, hostname), field, period,
+                    'mean', params
+                )
+                if (~np.isnan(rates)).any():
+                    stats['max_' + field] = int(np.nanmax(rates))
+            stats['saturated'] = stats['cpu'] > \
+                stats_settings.client_cpu_threshold
+            clients[host] = stats
+
+        if any(stats['saturated'] for stats in clients.values()):
+            logger.warn('Clients were saturated during {}: {}'.format(
+                phase, pretty_dict(clients)))
+        self.client_saturation[phase] = clients
+        return clients
+
     @property
     def calc_network_throughput(self):
         in_bytes_per_sec = []
         out_bytes_per_sec = []
-        for cluster_name, servers in self.cluster_spec.yield_clusters():
-            cluster = filter(lambda name: name.startswith(cluster_name),
-                             self.cluster_names)[0]
-            for server in servers:
-                hostname = server.split(':')[0].replace('.', '')
-                db = 'net{}{}'.format(cluster, hostname)
-                data = self.seriesly[db].get_all()
-                in_bytes_per_sec += [
-                    v['in_bytes_per_sec'] for v in data.values()
-                ]
-                out_bytes_per_sec += [
-                    v['out_bytes_per_sec'] for v in data.values()
-                ]
+        dbs = self._get_server_dbs('net')
+        for data in self.pool.map(lambda db: self.seriesly[db].get_all(),
+                                  dbs):
+            in_bytes_per_sec += [
+                v['in_bytes_per_sec'] for v in data.values()
+            ]
+            out_bytes_per_sec += [
+                v['out_bytes_per_sec'] for v in data.values()
+            ]
         # To prevent exception when the values may not be available during code debugging
         if not in_bytes_per_sec:
             in_bytes_per_sec.append(0)
@@ -451,7 +1163,9 @@ class SgwMetricHelper(MetricHelper):
 
     def __init__(self, *args, **kwargs):
         super(SgwMetricHelper, self).__init__(*args, **kwargs)
-        self.seriesly = Seriesly(self.test_config.gateload_settings.seriesly_host)
+        self.seriesly = RemoteSeriesly(
+            self.test_config.gateload_settings.seriesly_host,
+            pool_size=self.MAX_CONCURRENCY)
 
     def calc_push_latency(self, p=95, idx=1):
         query_params = self._get_query_params(
@@ -463,7 +1177,7 @@ class SgwMetricHelper(MetricHelper):
         if not self.seriesly[db].get_all():
             logger.error('No data in {}'.format(db))
 
-        data = self.seriesly[db].query(query_params)
+        data = self._query(db, query_params)
         if data.values()[0][0]:
             latency = float(data.values()[0][0])
             latency /= 10 ** 9  # ns -> s
@@ -473,21 +1187,15 @@ class SgwMetricHelper(MetricHelper):
         return round(latency, 2)
 
     def calc_requests_per_sec(self, idx=1):
-        query_params = self._get_query_params(
-            'avg_syncGateway_rest/requests_total'
-        )
-        query_params.update({'group': 1000})  # Group by 1 second
         db = 'gateway_{}'.format(idx)
         logger.info("Getting requests_per_sec for {}".format(db))
 
         if not self.seriesly[db].get_all():
             logger.error('No data in {}'.format(db))
 
-        data = self.seriesly[db].query(query_params)
-        total_requests = sorted(v[0] for v in data.values())
-        request_per_sec = [
-            n - c for c, n in zip(total_requests, total_requests[1:])
-        ]
+        _, request_per_sec = self._get_counter_rate(
+            db, '/syncGateway_rest/requests_total'
+        )
         return round(np.mean(request_per_sec))
 
     def calc_gateload_doc_counters(self, idx=1):
@@ -497,18 +1205,13 @@ class SgwMetricHelper(MetricHelper):
                      'doc_pulled',
                      'doc_failed_to_push',
                      'doc_failed_to_pull'):
-            query_params = self._get_query_params('max_gateload/total_{}'.format(item))
-            query_params.update({'group': 1000})  # Group by 1 second
-            data = self.seriesly[db].query(query_params)
-            values = sorted(v[0] for v in data.values())
-            values = values[-600:]  # Only take the last 10 minutes
-            values = [i for i in values if i is not None]
-            if len(values) > 2:
-                values_per_sec = [
-                    n - c for c, n in zip(values, values[1:])
-                ]
+            _, values_per_sec = self._get_counter_rate(
+                db, '/gateload/total_{}'.format(item)
+            )
+            values_per_sec = values_per_sec[-600:]  # Only take the last 10 minutes
+            if values_per_sec.size > 1:
                 counters['Average {}'.format(item)] = round(np.mean(values_per_sec))
-                counters['Max {}'.format(item)] = max(values_per_sec)
+                counters['Max {}'.format(item)] = values_per_sec.max()
             else:
                 counters['Average {}'.format(item)] = None
                 counters['Max {}'.format(item)] = None
@@ -1,4 +1,8 @@
+import ctypes
+import ctypes.util
 import json
+import os
+import time
 from hashlib import md5
 from uuid import uuid4
 
@@ -26,3 +30,46 @@ def target_hash(*args):
 def server_group(servers, group_number, i):
     group_id = 1 + i / ((len(servers) + 1) / group_number)
     return 'Group {}'.format(group_id)
+
+
+class _Timespec(ctypes.Structure):
+
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+CLOCK_MONOTONIC = 1  # Linux
+
+
+def _clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    return clock_gettime
+
+
+_clock = _clock_gettime()
+
+
+def monotonic():
+    """Seconds of CLOCK_MONOTONIC, which is not affected by NTP adjustments
+    of system time. Falls back to time.time() if clock is not available."""
+    if _clock is None:
+        return time.time()
+    t = _Timespec()
+    if _clock(CLOCK_MONOTONIC, ctypes.byref(t)):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+_epoch = time.time() - monotonic()
+
+
+def timestamp_ms():
+    """Current epoch time (ms) measured with the monotonic clock, so that
+    phase boundaries are precise and consistent with each other."""
+    return int(round((_epoch + monotonic()) * 1000))
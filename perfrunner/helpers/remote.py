@@ -30,6 +30,15 @@ def seriesly_host(task, *args, **kargs):
         return task(*args, **kargs)
 
 
+@decorator
+def all_clients(task, *args, **kargs):
+    self = args[0]
+    user, password = self.cluster_spec.client_credentials
+    with settings(user=user, password=password):
+        return execute(parallel(task), *args, hosts=self.cluster_spec.workers,
+                       **kargs)
+
+
 @decorator
 def all_gateways(task, *args, **kargs):
     self = args[0]
@@ -299,6 +308,11 @@ class RemoteLinuxHelper(object):
         logger.info('Detecting number of cores')
         return int(run('nproc', pty=False))
 
+    @all_clients
+    def detect_client_cores(self):
+        logger.info('Detecting number of cores on clients')
+        return int(run('nproc', pty=False))
+
     @all_hosts
     def detect_core_dumps(self):
         # Based on kernel.core_pattern = /tmp/core.%e.%p.%h.%t
@@ -8,7 +8,7 @@ from btrc import CouchbaseClient, StatsReporter
 from couchbase import Couchbase
 from logger import logger
 
-from perfrunner.helpers.misc import uhex, pretty_dict
+from perfrunner.helpers.misc import uhex, pretty_dict, timestamp_ms
 
 
 class BtrcReporter(object):
@@ -97,6 +97,29 @@ class Comparator(object):
 
         return {'changes': changes, 'reports': reports}
 
+    def _compare_values(self, benckmark, prev_build):
+        """Flag value change only if confidence intervals of the previous
+        and the new results don't overlap"""
+        if prev_build is None or 'ci' not in benckmark:
+            return {}
+
+        for row in self.cbb.query('benchmarks', 'values_by_build_and_metric',
+                                  key=[benckmark['metric'], prev_build]):
+            baseline = self.cbb.get(row.docid).value
+            if baseline.get('obsolete') or 'ci' not in baseline:
+                continue
+            significant = \
+                benckmark['ci']['low'] > baseline['ci']['high'] or \
+                benckmark['ci']['high'] < baseline['ci']['low']
+            return {'value_change': {
+                'baseline': baseline['value'],
+                'baseline_ci': baseline['ci'],
+                'value': benckmark['value'],
+                'ci': benckmark['ci'],
+                'significant': significant,
+            }}
+        return {}
+
     def __call__(self, test, benckmark):
         showfast = test.test_config.stats_settings.showfast
         cbmonitor = test.test_config.stats_settings.cbmonitor
@@ -122,6 +145,7 @@ class Comparator(object):
         changes = self._compare(cbmonitor=cbmonitor,
                                 prev_build=prev_build,
                                 new_build=benckmark['build'])
+        changes.update(self._compare_values(benckmark, prev_build))
         feed = dict(base_feed, **changes)
         self.cbf.set(_id, feed)
         logger.info('Snapshot comparison: {}'.format(pretty_dict(feed)))
@@ -173,6 +197,11 @@ class SFReporter(object):
             'value': value,
             'snapshots': self.test.snapshots
         }
+        data.update(self.test.metric_helper.annotations.get(metric, {}))
+        client_saturation = self.test.metric_helper.client_saturation
+        if any(stats['saturated'] for clients in client_saturation.values()
+               for stats in clients.values()):
+            data['client_saturation'] = client_saturation
         if self.test.master_events:
             data.update({'master_events': key})
         return key, data
@@ -284,12 +313,13 @@ class LogReporter(object):
 class Reporter(BtrcReporter, SFReporter, LogReporter):
 
     def start(self):
-        self.ts = time.time()
+        self.ts = timestamp_ms() / 1000.0
 
     def finish(self, action, time_elapsed=None):
-        time_elapsed = time_elapsed or (time.time() - self.ts)
-        time_elapsed = round(time_elapsed / 60, 1)
-        logger.info(
-            'Time taken to perform "{}": {} min'.format(action, time_elapsed)
-        )
-        return time_elapsed
+        """Log and return duration of action (min). Durations are measured
+        with the monotonic clock and reported with 3 decimal places, so that
+        short actions (e.g. failover) are not rounded away."""
+        time_elapsed = time_elapsed or (timestamp_ms() / 1000.0 - self.ts)
+        logger.info('Time taken to perform "{}": {:.3f} sec'.format(
+            action, time_elapsed))
+        return round(time_elapsed / 60, 3)
@@ -0,0 +1,502 @@
+import heapq
+import resource
+import time
+from collections import defaultdict
+from multiprocessing import Value
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from logger import logger
+
+from perfrunner.helpers.stores import BufferedStore, SyncStore
+
+
+class AdaptiveSampling(object):
+
+    """Adaptive sampling policy shared by all collector processes of a phase.
+
+    Collectors normally sample at their configured interval. When a trigger
+    fires (see Trigger) or boost() is called explicitly (e.g. when rebalance
+    starts), all adaptive collectors sample BOOST_FACTOR times more often
+    for BOOST_PERIOD seconds. After QUIET_PERIOD seconds without triggers
+    intervals are multiplied by DECIMATION.
+
+    A non-zero budget caps the number of samples per collector: every time
+    half of the remaining budget is used the interval is doubled, sampling
+    stops once the budget is exhausted.
+    """
+
+    BOOST_FACTOR = 5
+
+    BOOST_PERIOD = 60
+
+    QUIET_PERIOD = 600
+
+    DECIMATION = 4
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.started = time.time()
+        self.boost_until = Value('d', 0.0)
+
+    def restart(self):
+        """Start a new phase, e.g. when paused collectors resume."""
+        self.started = time.time()
+
+    def boost(self, period=BOOST_PERIOD):
+        with self.boost_until.get_lock():
+            self.boost_until.value = max(self.boost_until.value,
+                                         time.time() + period)
+
+    def boosted(self):
+        return time.time() < self.boost_until.value
+
+    def interval(self, base, samples):
+        """Return current interval of collector which has already taken
+        given number of samples, None if its budget is exhausted."""
+        now = time.time()
+        if now < self.boost_until.value:
+            interval = float(base) / self.BOOST_FACTOR
+        elif now - max(self.boost_until.value, self.started) > \
+                self.QUIET_PERIOD:
+            interval = base * self.DECIMATION
+        else:
+            interval = base
+
+        if self.budget:
+            if samples >= self.budget:
+                return None
+            remaining = self.budget - samples
+            interval *= 2 ** int(np.log2(float(self.budget) / remaining))
+        return interval
+
+
+class Trigger(object):
+
+    """Detects jumps in numeric fields of collector samples (e.g. disk write
+    queue or latency spikes): a value that deviates from its exponentially
+    weighted moving average by more than THRESHOLD mean absolute deviations
+    and by more than RATIO of the average. A field which appears after
+    warm-up (e.g. a new active task) fires as well."""
+
+    WARMUP = 10  # Samples
+
+    ALPHA = 0.1
+
+    THRESHOLD = 4
+
+    RATIO = 0.5
+
+    def __init__(self):
+        self.samples = 0
+        self.mean = {}
+        self.dev = {}
+
+    def __call__(self, doc):
+        self.samples += 1
+        fired = False
+        for field, value in doc.items():
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, long, float)):
+                continue
+            if field not in self.mean:
+                fired |= self.samples > self.WARMUP
+                self.mean[field], self.dev[field] = value, 0.0
+                continue
+            delta = abs(value - self.mean[field])
+            if self.samples > self.WARMUP and \
+                    delta > self.THRESHOLD * self.dev[field] and \
+                    delta > self.RATIO * abs(self.mean[field]):
+                fired = True
+            self.mean[field] += self.ALPHA * (value - self.mean[field])
+            self.dev[field] += self.ALPHA * (delta - self.dev[field])
+        return fired
+
+
+class ObservedStore(object):
+
+    """Collector store proxy which passes every sample to observer."""
+
+    def __init__(self, store, observer):
+        self.store = store
+        self.observer = observer
+
+    def append(self, data, **kwargs):
+        self.observer(data)
+        return self.store.append(data, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+class CollectorScheduler(object):
+
+    """Runs several cbagent collectors in a single process instead of one
+    process per collector.
+
+    Every collector keeps its own sampling deadlines: multiples of its
+    interval since start, so that time spent in sample() doesn't accumulate
+    as drift. Deadlines of all collectors are kept in a heap and the nearest
+    one is awaited. Blocking sample() calls are executed by a small thread
+    pool, so a slow collector doesn't delay the others. A collector is never
+    sampled concurrently with itself: if the previous sample is still in
+    progress the deadline is skipped.
+
+    Once stop event is set, no new samples are started. Samples in progress
+    are given up to drain_timeout seconds to complete, then collector stores
+    are flushed (if buffered). Skipped and abandoned samples are reported as
+    dropped.
+
+    The scheduler also measures its own overhead. Every report_interval
+    seconds it writes one document per collector to a separate cbagent_self
+    series. Each document has:
+        lag, max_lag    - delay of sample start after its deadline (ms)
+        duration        - time spent in sample() (ms)
+        request_latency - time of REST requests to the target (ms), if the
+                          collector uses get_http()
+        cpu, maxrss     - CPU utilization (%) and peak RSS of the process
+        over_budget     - samples skipped because sample budget of adaptive
+                          sampling was exhausted
+
+    With adaptive sampling (see AdaptiveSampling) collector intervals change
+    over time, unless fixed_rate is set (e.g. for latency collectors, which
+    generate load themselves). Samples of all collectors are still watched
+    for triggers.
+
+    Long-lived schedulers serve several phases of a test: sampling is paused
+    while running event is cleared (see run()), so collectors don't have to
+    be re-created, warmed up and re-connected for every phase.
+    """
+
+    MAX_THREADS = 8
+
+    DRAIN_TIMEOUT = 10
+
+    REPORT_INTERVAL = 10
+
+    MAX_WAIT = 1  # Max wait (sec) between checks of sampling state
+
+    SELF_COLLECTOR = 'cbagent_self'
+
+    def __init__(self, collectors, threads=MAX_THREADS,
+                 report_interval=REPORT_INTERVAL, adaptive=None,
+                 fixed_rate=False, names=None):
+        """Collector names (see collector_names()) must be unique across all
+        schedulers of the agent, as they share cbagent_self series."""
+        self.collectors = collectors
+        self.adaptive = adaptive
+        self.fixed_rate = fixed_rate
+        self.samples = [0] * len(collectors)
+        self.over_budget = [0] * len(collectors)
+        self.threads = min(threads, len(collectors)) or 1
+        self.report_interval = report_interval
+        self.busy = [False] * len(collectors)
+        self.skipped = [0] * len(collectors)
+        self.max_lag = [0.0] * len(collectors)
+        self.window = [defaultdict(float) for _ in collectors]
+        self.names = names or collector_names(collectors)
+        for i in range(len(collectors)):
+            self._instrument(i)
+            if adaptive is not None:
+                self._observe(i)
+
+    def _observe(self, i):
+        """Boost sampling of all collectors when samples of this one fire a
+        trigger."""
+        trigger = Trigger()
+
+        def observer(doc):
+            if trigger(doc):
+                if not self.adaptive.boosted():
+                    logger.info('Sampling boosted by {}'.format(self.name(i)))
+                self.adaptive.boost()
+
+        collector = self.collectors[i]
+        collector.store = ObservedStore(collector.store, observer)
+
+    def _interval(self, i):
+        interval = self.collectors[i].interval
+        if self.adaptive is None or self.fixed_rate:
+            return interval
+        return self.adaptive.interval(interval, self.samples[i])
+
+    def _instrument(self, i):
+        """Measure REST requests made by collector via get_http()."""
+        get_http = getattr(self.collectors[i], 'get_http', None)
+        if get_http is None:
+            return
+
+        def timed_get_http(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return get_http(*args, **kwargs)
+            finally:
+                self.window[i]['requests'] += 1
+                self.window[i]['request_time'] += time.time() - t0
+
+        self.collectors[i].get_http = timed_get_http
+
+    def _sample(self, i, deadline):
+        started = time.time()
+        try:
+            self.collectors[i].sample()
+        except Exception, e:
+            logger.warn('{}: {}'.format(self.name(i), e))
+        finally:
+            lag = max(started - deadline, 0)
+            window = self.window[i]
+            window['samples'] += 1
+            window['lag'] += lag
+            window['max_lag'] = max(window['max_lag'], lag)
+            window['duration'] += time.time() - started
+            self.max_lag[i] = max(self.max_lag[i], lag)
+            self.busy[i] = False
+
+    def _report(self, usage):
+        """Store overhead of every collector since the previous report.
+        Return current resource usage."""
+        now = time.time(), resource.getrusage(resource.RUSAGE_SELF)
+        (t0, ru0), (t1, ru1) = usage, now
+        cpu = 100 * (ru1.ru_utime + ru1.ru_stime - ru0.ru_utime -
+                     ru0.ru_stime) / max(t1 - t0, 1e-3)
+
+        for i, collector in enumerate(self.collectors):
+            window, self.window[i] = self.window[i], defaultdict(float)
+            if not window['samples'] and not window['over_budget']:
+                continue
+            doc = {
+                'cpu': cpu,
+                'maxrss': ru1.ru_maxrss * 1024,
+                'over_budget': window['over_budget'],
+            }
+            if window['samples']:
+                doc.update({
+                    'lag': 1000 * window['lag'] / window['samples'],
+                    'max_lag': 1000 * window['max_lag'],
+                    'duration': 1000 * window['duration'] / window['samples'],
+                })
+            if window['requests']:
+                doc['request_latency'] = \
+                    1000 * window['request_time'] / window['requests']
+            store = collector.store
+            if isinstance(store, ObservedStore):  # Not a trigger
+                store = store.store
+            try:
+                store.append(doc,
+                             cluster=getattr(collector, 'cluster', ''),
+                             server=self.names[i],
+                             collector=self.SELF_COLLECTOR)
+            except Exception, e:
+                logger.warn('{}: {}'.format(self.name(i), e))
+        return now
+
+    @staticmethod
+    def _next_deadline(deadline, interval, now):
+        deadline += interval
+        if deadline < now:  # Missed deadlines are skipped
+            deadline += interval * ((now - deadline) // interval + 1)
+        return deadline
+
+    def name(self, i):
+        return '{}{}'.format(self.names[i],
+                             getattr(self.collectors[i], 'cluster', ''))
+
+    def _drain(self, timeout):
+        """Wait for samples in progress, then flush stores."""
+        deadline = time.time() + timeout
+        while any(self.busy) and time.time() < deadline:
+            time.sleep(0.05)
+        stores = {}
+        for collector in self.collectors:
+            store = getattr(collector, 'store', None)
+            if isinstance(store, ObservedStore):
+                store = store.store
+            if hasattr(store, 'flush'):
+                stores[id(store)] = store
+        for store in stores.values():
+            try:
+                store.flush()
+            except Exception, e:
+                logger.warn('Failed to flush {}: {}'.format(
+                    type(store).__name__, e))
+
+    def _wait(self, delay, stop_event):
+        """Return True if stop event was set."""
+        if stop_event is None:
+            time.sleep(delay)
+            return False
+        return stop_event.wait(delay)
+
+    def _stop(self, drain_timeout):
+        """Complete samples in progress, then return final stats, so that
+        only abandoned samples are counted as dropped."""
+        self._drain(drain_timeout)
+        return self._stats()
+
+    def _stats(self):
+        return {
+            self.name(i): {'dropped': self.skipped[i] + int(self.busy[i]),
+                           'max_lag': self.max_lag[i],
+                           'interval': collector.interval,
+                           'samples': self.samples[i],
+                           'over_budget': self.over_budget[i]}
+            for i, collector in enumerate(self.collectors)
+        }
+
+    def _reset_stats(self):
+        size = len(self.collectors)
+        self.samples = [0] * size
+        self.over_budget = [0] * size
+        self.skipped = [0] * size
+        self.max_lag = [0.0] * size
+
+    def _pause(self, running, stop_event):
+        """Wait until running event is set again. Return False if stop event
+        was set instead."""
+        while not running.wait(self.MAX_WAIT):
+            if stop_event is not None and stop_event.is_set():
+                return False
+        return True
+
+    def run(self, stop_event=None, drain_timeout=DRAIN_TIMEOUT, running=None,
+            on_pause=None):
+        """Sample collectors until stop event is set. Return the number of
+        taken, dropped and over budget samples, the maximum lag (sec) and the
+        interval of every collector.
+
+        If running event is given, sampling is paused while it is cleared:
+        samples in progress are completed and stored, then stats since the
+        previous pause are passed to on_pause(). Sampling resumes with fresh
+        deadlines once the event is set again. None is returned if stop event
+        is set while paused."""
+        pool = ThreadPool(self.threads)
+        size = len(self.collectors)
+        check_interval = None
+        if self.adaptive is not None or running is not None:
+            check_interval = self.MAX_WAIT
+        try:
+            while True:
+                now = time.time()
+                deadlines = [(now, i) for i in range(size)]
+                previous = [now] * size  # Previous deadlines
+                boosted = False
+                usage = now, resource.getrusage(resource.RUSAGE_SELF)
+
+                while deadlines:
+                    if running is not None and not running.is_set():
+                        break
+
+                    if time.time() - usage[0] >= self.report_interval:
+                        usage = self._report(usage)
+
+                    if self.adaptive is not None and \
+                            self.adaptive.boosted() != boosted:
+                        # Reschedule according to new intervals
+                        boosted = not boosted
+                        deadlines = [
+                            (min(d, previous[i] + (self._interval(i) or 0)),
+                             i)
+                            for d, i in deadlines
+                        ]
+                        heapq.heapify(deadlines)
+
+                    deadline, i = heapq.heappop(deadlines)
+                    delay = deadline - time.time()
+                    if check_interval and delay > check_interval:
+                        heapq.heappush(deadlines, (deadline, i))
+                        if self._wait(check_interval, stop_event):
+                            return self._stop(drain_timeout)
+                        continue
+                    if delay > 0:
+                        if self._wait(delay, stop_event):
+                            return self._stop(drain_timeout)
+                    elif stop_event is not None and stop_event.is_set():
+                        return self._stop(drain_timeout)
+
+                    interval = self._interval(i)
+                    if interval is None:  # Budget is exhausted
+                        self.over_budget[i] += 1
+                        self.window[i]['over_budget'] += 1
+                        interval = self.collectors[i].interval
+                    elif self.busy[i]:
+                        self.skipped[i] += 1
+                    else:
+                        self.busy[i] = True
+                        self.samples[i] += 1
+                        pool.apply_async(self._sample, (i, deadline))
+
+                    previous[i] = deadline
+                    heapq.heappush(deadlines, (
+                        self._next_deadline(deadline, interval, time.time()),
+                        i
+                    ))
+                else:
+                    return self._stats()  # No collectors
+
+                self._drain(drain_timeout)
+                if on_pause is not None:
+                    on_pause(self._stats())
+                self._reset_stats()
+                if not self._pause(running, stop_event):
+                    return None
+                if self.adaptive is not None:
+                    self.adaptive.restart()
+        except BaseException:
+            self._drain(drain_timeout)
+            raise
+        finally:
+            pool.close()
+
+
+def collector_names(collectors):
+    """Names of collectors in cbagent_self series and collector stats:
+    collector type, numbered if there are several collectors of the same
+    type for the same cluster (e.g. persist and replicate latency)."""
+    keys = [(type(c).__name__, getattr(c, 'cluster', ''))
+            for c in collectors]
+    names = []
+    for i, key in enumerate(keys):
+        name = key[0]
+        if keys.count(key) > 1:
+            name = '{}{}'.format(name, keys[:i].count(key))
+        names.append(name)
+    return names
+
+
+def run_collectors(collectors, stop_event=None, results=None, seriesly=None,
+                   adaptive=None, fixed_rate=False, running=None, names=None):
+    """Process target: sample given collectors until stopped. Collector
+    stats (see CollectorScheduler.run) are sent to results queue (if any)
+    whenever sampling is paused or stopped.
+
+    Collector names should be computed for all collectors of the agent (see
+    collector_names()), so that they are unique across processes.
+
+    If seriesly (remote or local) is given, samples of all collectors are
+    written to it through a shared BufferedStore, which keeps true sample
+    timestamps."""
+    store = None
+    if seriesly is not None:
+        store = BufferedStore(seriesly, collectors[0].store.build_dbname)
+        for collector in collectors:
+            collector.store = store
+
+    on_pause = results.put if results is not None else None
+    scheduler = CollectorScheduler(collectors, adaptive=adaptive,
+                                   fixed_rate=fixed_rate, names=names)
+    stats = scheduler.run(stop_event, running=running, on_pause=on_pause)
+    if store is not None:
+        store.close()
+    if results is not None and stats is not None:
+        results.put(stats)
+
+
+def run_threaded_collector(collector, seriesly=None):
+    """Process target for collectors which sample in their own threads, i.e.
+    collect() never returns (e.g. XDCR lag or observe latency). They cannot
+    be driven by CollectorScheduler, their processes are terminated instead.
+    If seriesly is given, samples are written to it without buffering."""
+    if seriesly is not None:
+        collector.store = SyncStore(seriesly, collector.store.build_dbname)
+    collector.collect()
@@ -0,0 +1,389 @@
+import errno
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from itertools import islice
+from threading import Condition, Lock, Thread
+
+import numpy as np
+from logger import logger
+from requests.adapters import HTTPAdapter
+from seriesly import Seriesly
+from seriesly.core import Database
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_timestamps(keys):
+    """Convert seriesly (RFC 3339) document keys to epoch ms."""
+    keys = [k.rstrip('Z') for k in keys]
+    return np.array(keys, dtype='datetime64[ns]').astype(np.int64) // 10 ** 6
+
+
+def sort_keys(page):
+    """Return document keys of seriesly page ordered by time, and their
+    timestamps (ms). Keys cannot be compared as strings: seriesly trims
+    trailing zeros of fractions, e.g. "...:38Z" is earlier than "...:38.5Z".
+    """
+    keys = list(page)
+    timestamps = parse_timestamps(keys)
+    order = np.argsort(timestamps, kind='mergesort')
+    return [keys[i] for i in order], timestamps[order]
+
+
+def _reduce(reducer, values, starts):
+    """Reduce contiguous groups of values which begin at given offsets.
+    Missing values (NaN) are ignored like in seriesly."""
+    missing = np.isnan(values)
+    counts = np.add.reduceat((~missing).astype(np.int64), starts)
+    if reducer == 'count':
+        return counts.astype(np.float64)
+    if reducer == 'any':
+        return values[starts]
+    if reducer in ('min', 'max'):
+        func = np.fmin if reducer == 'min' else np.fmax
+        return func.reduceat(values, starts)
+
+    values = np.where(missing, 0, values)
+    if reducer == 'sumsq':
+        return np.add.reduceat(values ** 2, starts)
+    sums = np.add.reduceat(values, starts)
+    if reducer == 'sum':
+        return sums
+    if reducer == 'avg':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
+    raise ValueError('Unsupported reducer: {}'.format(reducer))
+
+
+def query_columns(timestamps, columns, params):
+    """Evaluate seriesly query (ptr, reducer, group, from, to) against
+    columnar data: sorted timestamps (ms) and dictionary of float64 arrays.
+    The output format is the same as in seriesly: {group_ts: [values]}."""
+    ptrs = params['ptr']
+    reducers = params['reducer']
+    if not isinstance(ptrs, (list, tuple)):
+        ptrs, reducers = [ptrs], [reducers]
+
+    lo, hi = 0, timestamps.size
+    if params.get('from') is not None:
+        lo = np.searchsorted(timestamps, int(params['from']), side='left')
+    if params.get('to') is not None:
+        hi = np.searchsorted(timestamps, int(params['to']), side='right')
+    if lo >= hi:
+        return {}
+    timestamps = np.asarray(timestamps[lo:hi])
+
+    group = int(params.get('group', 1))
+    keys = timestamps // group * group
+    starts = np.flatnonzero(np.diff(np.concatenate(([-1], keys))))
+
+    results = []
+    for ptr, reducer in zip(ptrs, reducers):
+        column = columns.get(ptr.lstrip('/'))
+        if column is None:
+            values = np.full(timestamps.size, np.nan)
+        else:
+            values = np.asarray(column[lo:hi], dtype=np.float64)
+        results.append(_reduce(reducer, values, starts))
+
+    return {
+        str(key): [None if np.isnan(r[i]) else float(r[i]) for r in results]
+        for i, key in enumerate(keys[starts])
+    }
+
+
+class SerieslyDatabase(Database):
+
+    PAGE_SIZE = 10000
+
+    def iter_all(self, params=None, page_size=PAGE_SIZE):
+        """Yield all documents page by page (ordered by timestamp) so that
+        large databases never have to be fully loaded into memory. Optional
+        params may limit the time range via 'from' and 'to'."""
+        url = self._dbname + '/_all'
+        params = dict(params or {}, limit=page_size)
+        last_ts = None
+        while True:
+            page = self._connection.get(url, params).json()
+            if last_ts is not None:
+                page.pop(last_ts, None)  # "from" is inclusive
+            if not page:
+                break
+            yield page
+            last_ts = sort_keys(page)[0][-1]
+            params['from'] = last_ts
+
+    def iter_series(self, field, params=None, page_size=PAGE_SIZE):
+        """Yield pairs of timestamps (ms) and values of a single field, one
+        pair per page. Missing values are NaN."""
+        for page in self.iter_all(params, page_size):
+            keys, timestamps = sort_keys(page)
+            values = np.array([to_float(page[ts].get(field)) for ts in keys])
+            yield timestamps, values
+
+
+class RemoteSeriesly(Seriesly):
+
+    """seriesly client which keeps up to pool_size connections alive so that
+    it can be safely shared by concurrent readers."""
+
+    POOL_SIZE = 16
+
+    def __init__(self, host, pool_size=POOL_SIZE):
+        super(RemoteSeriesly, self).__init__(host)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    def __getitem__(self, dbname):
+        return SerieslyDatabase(dbname=dbname, connection=self)
+
+
+class SyncStore(object):
+
+    """Unbuffered replacement of cbagent store (same append() interface) for
+    collectors whose processes are terminated rather than stopped, so that
+    no samples are left in memory."""
+
+    def __init__(self, seriesly, build_dbname):
+        self.seriesly = seriesly
+        self.build_dbname = build_dbname
+        self.dbs = set()
+        self.lock = Lock()
+
+    def append(self, data, **kwargs):
+        db = self.build_dbname(**kwargs)
+        with self.lock:
+            if db not in self.dbs:
+                if db not in self.seriesly.list_dbs():
+                    self.seriesly.create_db(db)
+                self.dbs.add(db)
+        self.seriesly[db].append(data)
+
+
+class BufferedStore(object):
+
+    """Write buffer between collectors and seriesly (RemoteSeriesly or
+    LocalSeriesly). It replaces the store of cbagent collectors (same
+    append() interface).
+
+    Samples are timestamped when appended, so that buffering doesn't shift
+    them in time. A background thread flushes the buffer when batch_size
+    samples are accumulated or every flush_interval seconds, grouped per
+    database and sent over a persistent connection, so collectors never wait
+    for the stats host.
+
+    At most max_samples are kept in memory. Extra samples, as well as
+    samples which failed to be written (e.g. stats host is unavailable), go
+    to an append-only spill file (JSON lines, one file per process) and are
+    replayed in batches as soon as the stats host is reachable again (after
+    a successful write or probe). Spill files left by processes which no
+    longer exist (e.g. after a crash) are replayed too.
+    """
+
+    BATCH_SIZE = 100
+
+    FLUSH_INTERVAL = 1  # sec
+
+    MAX_SAMPLES = 10000
+
+    SPILL_PATH = 'spill'
+
+    def __init__(self, seriesly, build_dbname, spill_path=SPILL_PATH,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_samples=MAX_SAMPLES):
+        self.seriesly = seriesly
+        self.build_dbname = build_dbname
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_samples = max_samples
+        if not os.path.exists(spill_path):
+            os.makedirs(spill_path)
+        self.spill_fname = os.path.join(spill_path,
+                                        '{}.json'.format(os.getpid()))
+        self.replays = 0
+        self._claim_orphans(spill_path)
+
+        self.buffer = []
+        self.dbs = set()
+        self.condition = Condition()
+        self.write_lock = Lock()
+        self.stats = defaultdict(float)
+        self.started = time.time()
+
+        self.stopped = False
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, data, **kwargs):
+        sample = (self.build_dbname(**kwargs), int(time.time() * 1000), data)
+        with self.condition:
+            if len(self.buffer) < self.max_samples:
+                self.buffer.append(sample)
+                if len(self.buffer) >= self.batch_size:
+                    self.condition.notify()
+                return
+        with self.write_lock:
+            self._spill([sample])
+
+    def _spill(self, samples):
+        with open(self.spill_fname, 'a') as fh:
+            for sample in samples:
+                fh.write(json.dumps(sample) + '\n')
+        self.stats['spilled'] += len(samples)
+
+    def _write(self, samples):
+        """Write samples grouped by database. Samples which cannot be written
+        are spilled. Return True if all samples were written."""
+        by_db = defaultdict(list)
+        for db, ts, doc in samples:
+            by_db[db].append((ts, doc))
+
+        t0 = time.time()
+        written = done = 0
+        try:
+            while by_db:
+                db, docs = by_db.popitem()
+                done = 0
+                if db not in self.dbs:
+                    if db not in self.seriesly.list_dbs():
+                        self.seriesly.create_db(db)
+                    self.dbs.add(db)
+                database = self.seriesly[db]
+                if hasattr(database, 'append_docs'):  # LocalSeriesly
+                    database.append_docs([ts for ts, _ in docs],
+                                         [doc for _, doc in docs])
+                    done = len(docs)
+                else:
+                    for ts, doc in docs:
+                        database.append(doc, timestamp=ts)
+                        done += 1
+                written += done
+        except Exception, e:
+            logger.warn('Failed to write samples: {}'.format(e))
+            written += done
+            by_db[db] = docs[done:]
+            self._spill([(db, ts, doc) for db, docs in by_db.items()
+                         for ts, doc in docs])
+            return False
+        finally:
+            self.stats['write_time'] += time.time() - t0
+            self.stats['written'] += written
+            self.stats['batches'] += 1
+        return True
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    def _next_replay_fname(self):
+        while True:
+            self.replays += 1
+            fname = '{}.replay{}'.format(self.spill_fname, self.replays)
+            if not os.path.exists(fname):
+                return fname
+
+    def _claim_orphans(self, spill_path):
+        """Take over spill (and replay) files of dead processes."""
+        for fname in glob.glob(os.path.join(spill_path, '*.json*')):
+            pid = os.path.basename(fname).split('.')[0]
+            if not pid.isdigit() or int(pid) == os.getpid() or \
+                    self._is_alive(int(pid)):
+                continue
+            try:
+                os.rename(fname, self._next_replay_fname())
+            except OSError:  # Claimed by another process
+                continue
+            logger.info('Found spilled samples: {}'.format(fname))
+
+    def _replay_file(self, fname):
+        """Write spilled samples in batches, so that memory usage doesn't
+        depend on file size. If a batch fails, the rest of the file is
+        spilled again. Return True if all samples were written."""
+        written = True
+        with open(fname) as fh:
+            while written:
+                batch = [json.loads(line)
+                         for line in islice(fh, self.batch_size)]
+                if not batch:
+                    break
+                self.stats['replayed'] += len(batch)
+                written = self._write(batch)
+            if not written:
+                with open(self.spill_fname, 'a') as spill:
+                    for line in fh:
+                        spill.write(line)
+                        self.stats['spilled'] += 1
+        os.remove(fname)
+        return written
+
+    def _replay(self):
+        if os.path.exists(self.spill_fname):
+            os.rename(self.spill_fname, self._next_replay_fname())
+        for fname in sorted(glob.glob(self.spill_fname + '.replay*')):
+            if not self._replay_file(fname):
+                break
+
+    def _can_replay(self):
+        """Check whether there are spilled samples and the stats host is
+        reachable again, when there is nothing new to write."""
+        if not os.path.exists(self.spill_fname) and \
+                not glob.glob(self.spill_fname + '.replay*'):
+            return False
+        try:
+            self.seriesly.list_dbs()
+        except Exception:
+            return False
+        return True
+
+    def flush(self):
+        """Write buffered samples, then replay spilled ones if the stats host
+        is reachable (even if the buffer is empty)."""
+        with self.condition:
+            samples, self.buffer = self.buffer, []
+        with self.write_lock:
+            if samples:
+                written = self._write(samples)
+            else:
+                written = self._can_replay()
+            if written:
+                self._replay()
+
+    def _run(self):
+        while not self.stopped:
+            with self.condition:
+                if len(self.buffer) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        """Flush remaining samples and report write path throughput."""
+        self.stopped = True
+        with self.condition:
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+
+        stats = self.stats
+        logger.info(
+            'Write path: {:.0f} samples in {:.0f} batches, {:.1f} samples/sec '
+            '({:.0f} samples/sec while writing), {:.0f} spilled, {:.0f} '
+            'replayed'.format(
+                stats['written'], stats['batches'],
+                stats['written'] / (time.time() - self.started),
+                stats['written'] / (stats['write_time'] or 1),
+                stats['spilled'], stats['replayed'],
+            )
+        )
@@ -0,0 +1,270 @@
+import numpy as np
+
+
+def rolling_mean_std(values, window):
+    """Mean and standard deviation of every full window of given size, both
+    computed from cumulative sums in O(n)."""
+    values = np.asarray(values, dtype=np.float64)
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    cumsum_sq = np.concatenate(([0.0], np.cumsum(values ** 2)))
+    mean = (cumsum[window:] - cumsum[:-window]) / window
+    var = (cumsum_sq[window:] - cumsum_sq[:-window]) / window - mean ** 2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+
+def steady_state(timestamps, values, window=30, threshold=0.1):
+    """Find the longest interval where the series is stable. Return the first
+    and the last timestamps of that interval, or None if there is not enough
+    data.
+
+    Every window of consecutive samples is considered stable when its rolling
+    mean is close to the reference level (the median of rolling means, ramp-up
+    and tail normally being a minority of samples):
+
+        |mean - level| <= threshold * |level| + 3 * sigma / sqrt(window)
+
+    where sigma is the median rolling standard deviation, so that noisy series
+    like latency are not over-trimmed. Outliers at the edges of the interval
+    are trimmed as well. Missing samples (NaN) are skipped.
+    """
+    timestamps = np.asarray(timestamps)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    timestamps, values = timestamps[valid], values[valid]
+    if values.size < 2 * window:
+        return None
+
+    mean, std = rolling_mean_std(values, window)
+    level, sigma = np.median(mean), np.median(std)
+    tolerance = threshold * abs(level) + 3 * sigma / np.sqrt(window)
+    stable = np.abs(mean - level) <= tolerance
+    if not stable.any():
+        return None
+
+    # Longest run of stable windows
+    edges = np.diff(np.concatenate(([0], stable.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    longest = np.argmax(ends - starts)
+    first, last = starts[longest], ends[longest] - 1 + window - 1
+
+    # Edge windows may still include a few outliers
+    outlier = np.abs(values - level) > threshold * abs(level) + 3 * sigma
+    while first < last and outlier[first]:
+        first += 1
+    while last > first and outlier[last]:
+        last -= 1
+
+    return int(timestamps[first]), int(timestamps[last])
+
+
+def change_points(values, penalty=None, min_size=5):
+    """Detect shifts of the mean by binary segmentation. Return sorted indices
+    of samples which start new segments.
+
+    For every candidate split of a segment the reduction of squared error is
+    evaluated at once from cumulative sums:
+
+        gain(k) = S(lo, k)^2 / (k - lo) + S(k, hi)^2 / (hi - k)
+                  - S(lo, hi)^2 / (hi - lo)
+
+    The best split is accepted if its gain exceeds the penalty, which defaults
+    to the BIC-like 2 * sigma^2 * log(n), where sigma is a robust (MAD-based)
+    estimate of noise from differences of consecutive samples.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values - values.mean()  # Better precision of cumulative sums
+    size = values.size
+    if size < 2 * min_size:
+        return []
+
+    if penalty is None:
+        diff = np.diff(values)
+        sigma = 1.4826 * np.median(np.abs(diff - np.median(diff))) / np.sqrt(2)
+        sigma = max(sigma, 1e-6 * np.abs(values).max())
+        penalty = 2 * sigma ** 2 * np.log(size)
+
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    points, segments = [], [(0, size)]
+    while segments:
+        lo, hi = segments.pop()
+        if hi - lo < 2 * min_size:
+            continue
+        k = np.arange(lo + min_size, hi - min_size + 1)
+        left = cumsum[k] - cumsum[lo]
+        right = cumsum[hi] - cumsum[k]
+        total = cumsum[hi] - cumsum[lo]
+        gain = left ** 2 / (k - lo) + right ** 2 / (hi - k) - \
+            total ** 2 / (hi - lo)
+        best = np.argmax(gain)
+        if gain[best] > penalty:
+            points.append(int(k[best]))
+            segments += [(lo, k[best]), (k[best], hi)]
+    return sorted(points)
+
+
+def fit_segments(values, points):
+    """Piecewise constant approximation: every sample is replaced with the
+    mean of its segment."""
+    values = np.asarray(values, dtype=np.float64)
+    bounds = np.concatenate(([0], points, [values.size])).astype(np.int64)
+    lengths = np.diff(bounds)
+    means = np.add.reduceat(values, bounds[:-1]) / lengths
+    return np.repeat(means, lengths)
+
+
+def parse_series(data, column=0):
+    """Convert seriesly query result ({ts: [values]}) to arrays of timestamps
+    (ms) and float values ordered by time. Missing values are NaN."""
+    timestamps = np.fromiter((int(ts) for ts in data), dtype=np.int64,
+                             count=len(data))
+    values = np.array([np.nan if v[column] is None else v[column]
+                       for v in data.values()], dtype=np.float64)
+    order = np.argsort(timestamps, kind='mergesort')
+    return timestamps[order], values[order]
+
+
+def counter_rate(timestamps, values, period=1000):
+    """Convert samples of a monotonic counter to rates (per second) resampled
+    to a fixed period (ms). Return timestamps (end of every period) and rates.
+
+    Samples may be out of order or missing (NaN). A counter which goes down
+    is considered reset (e.g. after restart), so the value right after the
+    reset is the increase since the previous sample. The increase between
+    samples is spread evenly over time, which also fills gaps.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    timestamps, values = timestamps[valid], values[valid]
+
+    order = np.argsort(timestamps, kind='mergesort')
+    timestamps, values = timestamps[order], values[order]
+    unique = np.concatenate(([True], np.diff(timestamps) > 0))
+    timestamps, values = timestamps[unique], values[unique]
+    if timestamps.size < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    increase = np.diff(values)
+    reset = increase < 0
+    increase[reset] = values[1:][reset]
+    total = np.concatenate(([0.0], np.cumsum(increase)))
+
+    grid = np.arange(timestamps[0], timestamps[-1] + 1, period)
+    if grid.size < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    rates = np.diff(np.interp(grid, timestamps, total)) * 1000.0 / period
+    return grid[1:], rates
+
+
+def align(series):
+    """Join several series (pairs of sorted timestamps and values) on common
+    timestamps. Return timestamps and 2-D array of values, one row per series.
+    Timestamps where any of values is missing are dropped."""
+    timestamps = reduce(np.intersect1d, [ts for ts, _ in series])
+    values = np.vstack([
+        np.asarray(v, dtype=np.float64)[np.searchsorted(ts, timestamps)]
+        for ts, v in series
+    ])
+    valid = ~np.isnan(values).any(axis=0)
+    return timestamps[valid], values[:, valid]
+
+
+class Resampler(object):
+
+    """Streaming resampler of a single series onto a fixed grid of timestamps
+    which are multiples of period (ms), so that independent series resampled
+    with the same period share the grid and can be joined with align().
+
+    Supported methods:
+        previous - the last known value (step function)
+        linear   - linear interpolation between neighbouring samples
+        sum      - sum of samples within [t, t + period)
+        mean     - average of samples within [t, t + period)
+
+    Samples must be fed in time order, chunk by chunk (e.g. seriesly pages).
+    Memory usage only depends on the number of grid points. Interpolation
+    never extrapolates beyond the first and the last samples.
+    """
+
+    METHODS = ('previous', 'linear', 'sum', 'mean')
+
+    def __init__(self, period=1000, method='linear'):
+        if method not in self.METHODS:
+            raise ValueError('Unknown method: {}'.format(method))
+        self.period = period
+        self.method = method
+        self.offset = None  # Index of the first grid point
+        self.values = np.empty(0)
+        self.counts = np.empty(0)
+        self.last = None  # The last sample, required for interpolation
+
+    def _extend(self, first, last):
+        """Make sure that grid points [first, last] are allocated."""
+        fill = 0 if self.method in ('sum', 'mean') else np.nan
+        if self.offset is None:
+            self.offset = first
+        size = last - self.offset + 1
+        if size > self.values.size:
+            size = max(size, 2 * self.values.size)  # Amortized growth
+            extra = size - self.values.size
+            self.values = np.concatenate((self.values, np.full(extra, fill)))
+            self.counts = np.concatenate((self.counts, np.zeros(extra)))
+
+    def update(self, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        timestamps, values = timestamps[valid], values[valid]
+        if not timestamps.size:
+            return
+
+        if self.method in ('sum', 'mean'):
+            bins = timestamps // self.period
+            self._extend(bins[0], bins[-1])
+            bins -= self.offset
+            size = self.values.size
+            self.values += np.bincount(bins, weights=values, minlength=size)
+            self.counts += np.bincount(bins, minlength=size)
+            return
+
+        if self.last is not None:
+            timestamps = np.concatenate(([self.last[0]], timestamps))
+            values = np.concatenate(([self.last[1]], values))
+        self.last = timestamps[-1], values[-1]
+
+        first = -(-timestamps[0] // self.period)  # ceil
+        last = timestamps[-1] // self.period
+        if first > last:
+            return
+        self._extend(first, last)
+        grid = np.arange(first, last + 1) * self.period
+        if self.method == 'previous':
+            resampled = values[np.searchsorted(timestamps, grid,
+                                               side='right') - 1]
+        else:
+            resampled = np.interp(grid, timestamps, values)
+        self.values[first - self.offset:last - self.offset + 1] = resampled
+        self.counts[first - self.offset:last - self.offset + 1] = 1
+
+    def result(self):
+        """Return grid timestamps and resampled values. Grid points without
+        data are NaN."""
+        if self.offset is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        used = np.flatnonzero(self.counts)
+        size = used[-1] + 1 if used.size else 0
+        timestamps = (self.offset + np.arange(size)) * self.period
+        values, counts = self.values[:size], self.counts[:size]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.method == 'mean':
+                values = values / counts
+            values = np.where(counts > 0, values, np.nan)
+        return timestamps, values
+
+
+def resample(timestamps, values, period=1000, method='linear'):
+    """Resample a single series, see Resampler."""
+    resampler = Resampler(period, method)
+    order = np.argsort(timestamps, kind='mergesort')
+    resampler.update(np.asarray(timestamps)[order], np.asarray(values)[order])
+    return resampler.result()
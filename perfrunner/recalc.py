@@ -0,0 +1,152 @@
+import ast
+import glob
+import json
+import os.path
+from collections import OrderedDict
+from optparse import OptionParser
+
+from logger import logger
+
+from perfrunner.helpers.archive import ArchiveSeriesly, SnapshotArchiver
+from perfrunner.helpers.metrics import AGGREGATES, METRICS, MetricHelper
+from perfrunner.helpers.misc import pretty_dict
+from perfrunner.settings import ClusterSpec, TestConfig
+
+
+def get_options():
+    usage = '%prog -c cluster -t test_config [-a archive] [-p phase] ' \
+            '"calc_method(args)" | metric[:aggregate] ...'
+
+    parser = OptionParser(usage)
+
+    parser.add_option('-c', dest='cluster_spec_fname',
+                      help='path to cluster specification file',
+                      metavar='cluster.spec')
+    parser.add_option('-t', dest='test_config_fname',
+                      help='path to test configuration file',
+                      metavar='my_test.test')
+    parser.add_option('-a', dest='archive', default=SnapshotArchiver.ROOT,
+                      help='path to snapshot archive (default: snapshots)',
+                      metavar='snapshots')
+    parser.add_option('-p', dest='phase',
+                      help='with_stats phase to use, e.g. access',
+                      metavar='access')
+
+    options, args = parser.parse_args()
+    if not options.cluster_spec_fname or not options.test_config_fname:
+        parser.error('Missing mandatory parameter')
+    if not args:
+        parser.error('Missing metric, e.g. "calc_kv_latency(\'get\', 95)"')
+
+    return options, args
+
+
+class ArchivedRun(object):
+
+    """Replacement for PerfTest which only exposes attributes required by
+    MetricHelper. Cluster names and build are restored from manifests."""
+
+    def __init__(self, cluster_spec, test_config, manifests):
+        self.cluster_spec = cluster_spec
+        self.test_config = test_config
+        self.build = manifests[0].get('build', '')
+        self.master_node = cluster_spec.yield_masters().next()
+
+        clusters = OrderedDict()
+        for cluster_name, servers in cluster_spec.yield_clusters():
+            for manifest in manifests:
+                if manifest['cluster'].startswith(cluster_name):
+                    clusters[manifest['cluster']] = servers[0]
+        self.cbagent = type('cbagent', (object, ), {'clusters': clusters})
+
+
+# Metric methods of MetricHelper (including properties) which can be called
+CALC_METHODS = {name: method for name, method in vars(MetricHelper).items()
+                if name.startswith('calc_')}
+
+
+def parse_call(expression):
+    """Parse "calc_method(args)" expression. Only literal arguments are
+    accepted. Return method name, args and kwargs."""
+    try:
+        node = ast.parse(expression, mode='eval').body
+        if isinstance(node, ast.Name):
+            return node.id, [], {}
+        if not isinstance(node, ast.Call) or \
+                not isinstance(node.func, ast.Name) or \
+                node.starargs or node.kwargs:
+            raise ValueError
+        args = [ast.literal_eval(arg) for arg in node.args]
+        kwargs = {kw.arg: ast.literal_eval(kw.value)
+                  for kw in node.keywords}
+    except (SyntaxError, ValueError):
+        logger.interrupt('Cannot parse: {}'.format(expression))
+    return node.func.id, args, kwargs
+
+
+def calculate(metric_helper, expression):
+    """Calculate either a registered metric with optional aggregate (e.g.
+    "avg_cpu_utilization_rate:max") or a metric method of MetricHelper."""
+    name, _, aggregate = expression.partition(':')
+    if name in METRICS:
+        if aggregate and aggregate not in AGGREGATES:
+            logger.interrupt('Unknown aggregate: {}, use one of: {}'.format(
+                aggregate, sorted(AGGREGATES)))
+        return metric_helper._calc_metric(name, aggregate=aggregate or None)
+
+    name, args, kwargs = parse_call(expression)
+    method = CALC_METHODS.get(name)
+    if method is None:
+        logger.interrupt('Not a metric: {}'.format(expression))
+    if isinstance(method, property):
+        if args or kwargs:
+            logger.interrupt('{} takes no arguments'.format(name))
+        return getattr(metric_helper, name)
+    return method(metric_helper, *args, **kwargs)
+
+
+def load_manifests(archive, phase):
+    manifests = []
+    for fname in sorted(glob.glob(os.path.join(archive, '*',
+                                               'manifest.json'))):
+        with open(fname) as fh:
+            manifest = json.load(fh)
+        if phase is None or manifest.get('phase') == phase:
+            manifest['path'] = os.path.dirname(fname)
+            manifests.append(manifest)
+
+    clusters = [m['cluster'] for m in manifests]
+    if not manifests:
+        logger.interrupt('No snapshots found in {}'.format(archive))
+    if len(set(clusters)) != len(clusters):
+        logger.interrupt('Several phases found, please specify one of: {}'
+                         .format(sorted({m.get('phase') for m in manifests})))
+    return manifests
+
+
+def main():
+    options, args = get_options()
+
+    cluster_spec = ClusterSpec()
+    cluster_spec.parse(options.cluster_spec_fname)
+    test_config = TestConfig()
+    test_config.parse(options.test_config_fname)
+
+    manifests = load_manifests(options.archive, options.phase)
+    run = ArchivedRun(cluster_spec, test_config, manifests)
+
+    metric_helper = MetricHelper(run)
+    metric_helper.seriesly = ArchiveSeriesly([m['path'] for m in manifests])
+
+    results = OrderedDict()
+    for expression in args:
+        results[expression] = calculate(metric_helper, expression)
+    logger.info('Recalculated metrics: {}'.format(pretty_dict(results)))
+    if metric_helper.annotations:
+        logger.info('Annotations: {}'.format(
+            pretty_dict(metric_helper.annotations)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -290,29 +290,93 @@ class ClusterSettings(object):
 
 class StatsSettings(object):
 
+    ARCHIVE = 0
     CBMONITOR = {'host': 'cbmonitor.sc.couchbase.com', 'password': 'password'}
+    CLIENT_STATS = 0
+    CLIENT_CPU_THRESHOLD = 90  # % of all cores
+    CLIENT_SATURATION_WINDOW = 60  # sec
+    CONFIDENCE_INTERVALS = 0
     ENABLED = 1
     POST_TO_SF = 0
     INTERVAL = 5
     LAT_INTERVAL = 1
+    COLLECTOR_PROCESSES = 0  # One process per collector
+    LONG_LIVED_COLLECTORS = 0
+    BUFFERED_WRITES = 0
+    SAMPLING_LAG_THRESHOLD = 0.5  # Fraction of interval
+    ADAPTIVE_SAMPLING = 0
+    SAMPLE_BUDGET = 0  # Max samples per collector and phase, 0 - unlimited
+    LATENCY_CORRECTION = 0
+    LATENCY_PERCENTILES = [95]
     POST_RSS = 0
     POST_CPU = 0
+    POST_EFFICIENCY = 0
+    POST_AMPLIFICATION = 0
     SERIESLY = {'host': 'cbmonitor.sc.couchbase.com'}
+    STORE = 'seriesly'  # or 'local'
+    STORE_PATH = 'stats'
     SHOWFAST = {'host': 'showfast.sc.couchbase.com', 'password': 'password'}
+    STEADY_STATE = 0
+    STEADY_STATE_WINDOW = 30  # Samples
+    STEADY_STATE_THRESHOLD = 0.1
 
     def __init__(self, options):
         self.cbmonitor = {'host': options.get('cbmonitor_host',
                                               self.CBMONITOR['host']),
                           'password': options.get('cbmonitor_password',
                                                   self.CBMONITOR['password'])}
+        self.client_stats = int(options.get('client_stats', self.CLIENT_STATS))
+        self.client_cpu_threshold = float(
+            options.get('client_cpu_threshold', self.CLIENT_CPU_THRESHOLD)
+        )
+        self.client_saturation_window = int(
+            options.get('client_saturation_window',
+                        self.CLIENT_SATURATION_WINDOW)
+        )
         self.enabled = int(options.get('enabled', self.ENABLED))
         self.post_to_sf = int(options.get('post_to_sf', self.POST_TO_SF))
         self.interval = int(options.get('interval', self.INTERVAL))
         self.lat_interval = int(options.get('lat_interval', self.LAT_INTERVAL))
+        self.collector_processes = int(options.get('collector_processes',
+                                                   self.COLLECTOR_PROCESSES))
+        self.long_lived_collectors = int(
+            options.get('long_lived_collectors', self.LONG_LIVED_COLLECTORS)
+        )
+        self.buffered_writes = int(options.get('buffered_writes',
+                                               self.BUFFERED_WRITES))
+        self.sampling_lag_threshold = float(
+            options.get('sampling_lag_threshold', self.SAMPLING_LAG_THRESHOLD)
+        )
+        self.adaptive_sampling = int(options.get('adaptive_sampling',
+                                                 self.ADAPTIVE_SAMPLING))
+        self.sample_budget = int(options.get('sample_budget',
+                                             self.SAMPLE_BUDGET))
+        self.latency_correction = int(options.get('latency_correction',
+                                                  self.LATENCY_CORRECTION))
+        self.latency_percentiles = [
+            float(p) if '.' in p else int(p)
+            for p in options.get('latency_percentiles', '').split()
+        ] or self.LATENCY_PERCENTILES
         self.post_rss = int(options.get('post_rss', self.POST_RSS))
         self.post_cpu = int(options.get('post_cpu', self.POST_CPU))
+        self.post_efficiency = int(options.get('post_efficiency',
+                                               self.POST_EFFICIENCY))
+        self.post_amplification = int(options.get('post_amplification',
+                                                  self.POST_AMPLIFICATION))
+        self.archive = int(options.get('archive', self.ARCHIVE))
+        self.confidence_intervals = int(options.get('confidence_intervals',
+                                                    self.CONFIDENCE_INTERVALS))
+        self.steady_state = int(options.get('steady_state',
+                                            self.STEADY_STATE))
+        self.steady_state_window = int(options.get('steady_state_window',
+                                                   self.STEADY_STATE_WINDOW))
+        self.steady_state_threshold = float(
+            options.get('steady_state_threshold', self.STEADY_STATE_THRESHOLD)
+        )
         self.seriesly = {'host': options.get('seriesly_host',
                                              self.SERIESLY['host'])}
+        self.store = options.get('store', self.STORE)
+        self.store_path = options.get('store_path', self.STORE_PATH)
         self.showfast = {'host': options.get('showfast_host',
                                              self.SHOWFAST['host']),
                          'password': options.get('showfast_password',
@@ -396,6 +460,10 @@ class RebalanceSettings(object):
     SLEEP_AFTER_FAILOVER = 600
     START_AFTER = 1200
     STOP_AFTER = 1200
+    POST_IMPACT = 0
+    # Max degradation (fraction of pre-rebalance level) after rebalance that
+    # still counts as recovered
+    RECOVERY_TOLERANCE = 0.1
 
     def __init__(self, options):
         self.nodes_after = [int(_) for _ in options.get('nodes_after').split()]
@@ -409,6 +477,9 @@ class RebalanceSettings(object):
                                               self.DELTA_RECOVERY))
         self.start_after = int(options.get('start_after', self.START_AFTER))
         self.stop_after = int(options.get('stop_after', self.STOP_AFTER))
+        self.post_impact = int(options.get('post_impact', self.POST_IMPACT))
+        self.recovery_tolerance = float(options.get('recovery_tolerance',
+                                                    self.RECOVERY_TOLERANCE))
 
 
 class PhaseSettings(object):
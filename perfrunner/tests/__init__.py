@@ -79,6 +79,8 @@ class PerfTest(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cbagent.shutdown()
+        self.cbagent.collect_reports()
         if self.test_config.test_case.use_workers:
             self.worker_manager.terminate()
         if exc_type != exc.KeyboardInterrupt and '--nodebug' not in sys.argv:
@@ -32,6 +32,11 @@ class BucketCompactionTest(PerfTest):
             self.metric_helper.calc_compaction_speed(time_elapsed, bucket=True)
         self.reporter.post_to_sf(compaction_speed)
 
+        if self.test_config.stats_settings.post_amplification:
+            self.reporter.post_to_sf(
+                *self.metric_helper.calc_space_amplification()
+            )
+
 
 class IndexCompactionTest(IndexTest):
 
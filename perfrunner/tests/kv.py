@@ -45,6 +45,19 @@ class KVTest(PerfTest):
         self.access_bg()
         self.access()
 
+        if self.test_config.stats_settings.enabled and \
+                self.test_config.stats_settings.post_efficiency:
+            for efficiency in self.metric_helper.calc_efficiency():
+                self.reporter.post_to_sf(*efficiency)
+        if self.test_config.stats_settings.enabled and \
+                self.test_config.stats_settings.post_amplification:
+            self.reporter.post_to_sf(
+                *self.metric_helper.calc_write_amplification()
+            )
+            self.reporter.post_to_sf(
+                *self.metric_helper.calc_space_amplification()
+            )
+
 
 class PersistLatencyTest(KVTest):
 
@@ -84,14 +97,34 @@ class MixedLatencyTest(KVTest):
 
     COLLECTORS = {'latency': True}
 
+    def report_kv_latency(self, operations):
+        """Post configured percentiles of given operations (side by side with
+        values corrected for coordinated omission if enabled) and log the
+        whole percentile ladder. Return uncorrected values."""
+        stats_settings = self.test_config.stats_settings
+        latencies = []
+        for operation in operations:
+            for percentile in stats_settings.latency_percentiles:
+                latencies.append(self.reporter.post_to_sf(
+                    *self.metric_helper.calc_kv_latency(operation=operation,
+                                                        percentile=percentile)
+                ))
+                if stats_settings.latency_correction:
+                    self.reporter.post_to_sf(
+                        *self.metric_helper.calc_kv_latency(
+                            operation=operation, percentile=percentile,
+                            corrected=True
+                        )
+                    )
+        logger.info('Latency percentiles: {}'.format(
+            pretty_dict(self.metric_helper.calc_latency_percentiles())
+        ))
+        return latencies
+
     def run(self):
         super(MixedLatencyTest, self).run()
         if self.test_config.stats_settings.enabled:
-            for operation in ('get', 'set'):
-                self.reporter.post_to_sf(
-                    *self.metric_helper.calc_kv_latency(operation=operation,
-                                                        percentile=95)
-                )
+            self.report_kv_latency(operations=('get', 'set'))
 
 
 class ReadLatencyTest(MixedLatencyTest):
@@ -105,12 +138,9 @@ class ReadLatencyTest(MixedLatencyTest):
     def run(self):
         super(MixedLatencyTest, self).run()
         if self.test_config.stats_settings.enabled:
-            latency_get = self.reporter.post_to_sf(
-                *self.metric_helper.calc_kv_latency(operation='get',
-                                                    percentile=95)
-            )
+            latency_get = self.report_kv_latency(operations=('get', ))
             if hasattr(self, 'experiment'):
-                self.experiment.post_results(latency_get)
+                self.experiment.post_results(latency_get[0])
 
 
 class BgFetcherTest(KVTest):
@@ -1,10 +1,11 @@
 import time
 
 from decorator import decorator
+from logger import logger
 
 
 from perfrunner.helpers.cbmonitor import with_stats
-from perfrunner.helpers.misc import server_group
+from perfrunner.helpers.misc import server_group, timestamp_ms
 from perfrunner.tests import PerfTest
 from perfrunner.tests.index import IndexTest
 from perfrunner.tests.query import QueryTest
@@ -34,6 +35,8 @@ def with_reporter(rebalance, *args, **kwargs):
     rebalance(*args, **kwargs)
 
     test.rebalance_time = test.reporter.finish('Rebalance')
+    test.rebalance_started, test.rebalance_finished = \
+        test.reporter.ts, timestamp_ms() / 1000.0
 
     test.reporter.save_utilzation_stats()
     test.reporter.save_master_events()
@@ -43,12 +46,14 @@ def with_reporter(rebalance, *args, **kwargs):
 def with_delayed_posting(rebalance, *args, **kwargs):
     test = args[0]
 
-    rebalance(*args, **kwargs)
+    from_ts, to_ts = rebalance(*args, **kwargs)  # See with_stats
 
     if test.is_balanced():
         test.reporter.post_to_sf(test.rebalance_time)
         if hasattr(test, 'experiment'):
             test.experiment.post_results(test.rebalance_time)
+        if test.IMPACT_SERIES:
+            test.report_impact(from_ts, to_ts)
 
 
 class RebalanceTest(PerfTest):
@@ -75,10 +80,22 @@ class RebalanceTest(PerfTest):
 
     ALL_HOSTNAMES = True
 
+    IMPACT_SERIES = ()  # See MetricHelper.REBALANCE_IMPACT
+
     def __init__(self, *args, **kwargs):
         super(RebalanceTest, self).__init__(*args, **kwargs)
         self.rebalance_settings = self.test_config.rebalance_settings
 
+    def report_impact(self, from_ts, to_ts):
+        impact = self.metric_helper.calc_rebalance_impact(
+            self.IMPACT_SERIES, self.rebalance_started,
+            self.rebalance_finished, from_ts, to_ts
+        )
+        for value, metric, metric_info in impact:
+            logger.info('{}: {}'.format(metric, value))
+            if self.rebalance_settings.post_impact:
+                self.reporter.post_to_sf(value, metric, metric_info)
+
     def is_balanced(self):
         for master in self.cluster_spec.yield_masters():
             if not self.rest.is_balanced(master):
@@ -145,6 +162,8 @@ class RebalanceTest(PerfTest):
             else:
                 continue
 
+            self.cbagent.boost()  # Topology changes, sample more often
+
             for i, host_port in new_nodes:
                 group = server_group(servers[:nodes_after], group_number, i)
                 uri = groups.get(group)
@@ -156,7 +175,8 @@ class RebalanceTest(PerfTest):
                     self.rest.set_delta_recovery_type(master, host_port)
             for host_port in graceful_failover_nodes:
                 self.rest.graceful_fail_over(master, host_port)
-                self.monitor.monitor_rebalance(master)
+                with self.cbagent.sub_phase('failover'):
+                    self.monitor.monitor_rebalance(master)
                 self.rest.add_back(master, host_port)
 
             if graceful_failover:
@@ -169,12 +189,14 @@ class RebalanceTest(PerfTest):
                 time.sleep(sleep_after_failover)
                 self.reporter.start()
 
+            self.cbagent.boost()
             self.rest.rebalance(master, known_nodes, ejected_nodes)
 
             for _, host_port in new_nodes:
                 self.change_watermarks(host_port)
 
-            self.monitor.monitor_rebalance(master)
+            with self.cbagent.sub_phase('rebalance'):
+                self.monitor.monitor_rebalance(master)
 
 
 class StaticRebalanceTest(RebalanceTest):
@@ -216,6 +238,8 @@ class RebalanceKVTest(RebalanceTest):
 
     COLLECTORS = {'latency': True}
 
+    IMPACT_SERIES = ('ops', 'latency_get', 'latency_set')
+
     def run(self):
         self.load()
         self.wait_for_persistence()
@@ -237,6 +261,9 @@ class RebalanceWithQueriesTest(QueryTest, RebalanceTest):
 
     COLLECTORS = {'latency': True, 'query_latency': True}
 
+    IMPACT_SERIES = ('ops', 'latency_get', 'latency_set',
+                     'latency_query')
+
     def run(self):
         self.load()
         self.wait_for_persistence()
@@ -261,6 +288,8 @@ class RebalanceWithXdcrTest(XdcrTest, RebalanceTest):
 
     COLLECTORS = {'latency': True, 'xdcr_lag': True}
 
+    IMPACT_SERIES = ('ops', 'latency_get', 'latency_set', 'xdcr_lag')
+
     def run(self):
         self.load()
         self.wait_for_persistence()
@@ -286,6 +315,8 @@ class RebalanceWithSymmetricXdcrTest(SymmetricXdcrTest, RebalanceTest):
 
     COLLECTORS = {'latency': True, 'xdcr_lag': True}
 
+    IMPACT_SERIES = ('ops', 'latency_get', 'latency_set', 'xdcr_lag')
+
     def run(self):
         self.load()
         self.wait_for_persistence()
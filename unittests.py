@@ -1,9 +1,32 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from threading import Event, Thread, Timer
 from unittest import TestCase
 
+import numpy as np
 from mock import patch
 
-from perfrunner.helpers.misc import target_hash, server_group
-from perfrunner.settings import TestConfig
+from perfrunner.helpers.archive import (ArchiveSeriesly, LocalSeriesly,
+                                        SnapshotArchiver)
+from perfrunner.helpers.bootstrap import BlockBootstrap
+from perfrunner.helpers.histograms import HdrHistogram
+from perfrunner.helpers.metrics import (AGGREGATES, METRICS, UNITS,
+                                        MetricHelper)
+from perfrunner.helpers.misc import (monotonic, server_group, target_hash,
+                                     timestamp_ms)
+from perfrunner.helpers.scheduler import (AdaptiveSampling,
+                                          CollectorScheduler, Trigger,
+                                          collector_names)
+from perfrunner.helpers.stores import (BufferedStore, SerieslyDatabase,
+                                       parse_timestamps, query_columns)
+from perfrunner.helpers.timeseries import (Resampler, align, change_points,
+                                           counter_rate, fit_segments,
+                                           resample, steady_state)
+from perfrunner.recalc import ArchivedRun, load_manifests, parse_call
+from perfrunner.settings import ClusterSpec, TestConfig
 from perfrunner.utils.install import CouchbaseInstaller, Build
 from perfrunner.utils.install_gw import GatewayInstaller
 from perfrunner.workloads.tcmalloc import (KeyValueIterator,
@@ -107,6 +130,12 @@ class InstallTest(TestCase):
     def test_target_hash(self):
         self.assertEqual(target_hash('127.0.0.1'), '3cf55f')
 
+    def test_monotonic_timestamps(self):
+        timestamps = [timestamp_ms() for _ in range(1000)]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertAlmostEqual(timestamps[-1], time.time() * 1000, delta=1000)
+        self.assertLess(monotonic(), monotonic())
+
 
 class RebalanceTests(TestCase):
 
@@ -186,3 +215,529 @@ class WorkloadTest(TestCase):
             values = [len(str(v)) for k, v in batch]
             mean = sum(values) / len(values)
             self.assertAlmostEqual(mean, 256000, delta=51200)
+
+
+class HistogramTest(TestCase):
+
+    def test_percentiles_within_error_bound(self):
+        random = np.random.RandomState(0)
+        samples = random.lognormal(mean=0.5, sigma=1.0, size=100000)
+        histogram = HdrHistogram()
+        for chunk in np.array_split(samples, 10):
+            histogram.record_values(chunk)
+        ordered = np.sort(samples)
+        for p in (50, 90, 95, 99, 99.9):
+            exact = ordered[int(np.ceil(p / 100.0 * samples.size)) - 1]
+            self.assertAlmostEqual(histogram.percentile(p), exact,
+                                   delta=max(0.001, exact * 10 ** -3))
+        self.assertEqual(histogram.count, samples.size)
+        self.assertEqual(histogram.percentile(100), samples.max())
+
+    def test_merge(self):
+        h1, h2 = HdrHistogram(), HdrHistogram()
+        h1.record_values(range(1, 501))
+        h2.record_values(range(501, 1001))
+        h1.merge(h2)
+        self.assertEqual(h1.count, 1000)
+        self.assertAlmostEqual(h1.percentile(50), 500, delta=0.5)
+        self.assertEqual(h1.min, 1)
+
+    def test_coordinated_omission(self):
+        histogram = HdrHistogram()
+        histogram.record_corrected_values([1, 1, 1, 10], expected_interval=2)
+        self.assertEqual(histogram.count, 8)  # 10 -> 8, 6, 4, 2
+        self.assertAlmostEqual(histogram.percentile(50), 2, delta=0.01)
+        self.assertEqual(histogram.max, 10)
+
+
+class StoresTest(TestCase):
+
+    def test_query_columns(self):
+        timestamps = np.arange(0, 100000, 1000)
+        columns = {'ops': np.arange(100, dtype=np.float64)}
+        columns['ops'][5] = np.nan
+
+        data = query_columns(timestamps, columns,
+                             {'ptr': ['/ops', '/ops'],
+                              'reducer': ['avg', 'count'],
+                              'group': 10000, 'from': 0, 'to': 19000})
+        self.assertEqual(sorted(data), ['0', '10000'])
+        self.assertEqual(data['0'], [40 / 9.0, 9])
+        self.assertEqual(data['10000'], [14.5, 10])
+
+        data = query_columns(timestamps, columns,
+                             {'ptr': '/missing', 'reducer': 'max',
+                              'group': 10 ** 12})
+        self.assertEqual(data, {'0': [None]})
+
+    def test_iter_all_pages(self):
+        class Connection(object):  # Seriesly trims trailing zeros of keys
+
+            docs = {'2015-01-01T00:00:{}Z'.format(s): {'ops': 1}
+                    for s in ('37.5', '38', '38.5', '39', '39.25', '40')}
+
+            def get(self, url, params):
+                keys = sorted(self.docs, key=lambda k: parse_timestamps([k]))
+                if 'from' in params:
+                    keys = keys[keys.index(params['from']):]
+                page = {k: self.docs[k] for k in keys[:params['limit']]}
+                return type('Response', (object, ), {'json': lambda _: page})()
+
+        db = SerieslyDatabase(dbname='ns_server', connection=Connection())
+        keys = [key for page in db.iter_all(page_size=3) for key in page]
+        self.assertEqual(sorted(keys), sorted(Connection.docs))
+
+    def test_local_seriesly(self):
+        root = tempfile.mkdtemp()
+        try:
+            seriesly = LocalSeriesly(root)
+            seriesly.create_db('ns_server')
+            db = seriesly['ns_server']
+            for ts in (3000, 1000, 2000, 11000):  # Out of order
+                db.append({'ops': ts / 1000}, timestamp=ts)
+            db.append({'ops': 20, 'mem_used': 100}, timestamp=12000)
+
+            self.assertEqual(seriesly.list_dbs(), ['ns_server'])
+            data = seriesly['ns_server'].query({
+                'ptr': ['/ops', '/mem_used'], 'reducer': ['avg', 'max'],
+                'group': 10000,
+            })
+            self.assertEqual(data, {'0': [2, None], '10000': [15.5, 100]})
+            docs = seriesly['ns_server'].get_all()
+            self.assertEqual(len(docs), 5)
+            self.assertEqual(docs['1970-01-01T00:00:12.000Z'],
+                             {'ops': 20, 'mem_used': 100})
+            seriesly.close()
+        finally:
+            shutil.rmtree(root)
+
+    def test_concurrent_writers(self):
+        root = tempfile.mkdtemp()
+        try:
+            writers = LocalSeriesly(root), LocalSeriesly(root)
+            writers[0].create_db('atop')
+            writers[0]['atop'].append({'cpu': 1}, timestamp=1000)
+            writers[1]['atop'].append({'mem': 2}, timestamp=2000)
+            writers[0]['atop'].append({'cpu': 3}, timestamp=3000)
+            writers[1].close()
+            writers[0].close()
+
+            data = writers[0]['atop'].query({'ptr': ['/cpu', '/mem'],
+                                             'reducer': ['sum', 'count'],
+                                             'group': 10 ** 12})
+            self.assertEqual(data, {'0': [4, 1]})
+            docs = writers[0]['atop'].get_all()
+            self.assertEqual(docs['1970-01-01T00:00:02.000Z'], {'mem': 2})
+        finally:
+            shutil.rmtree(root)
+
+    def test_open_files_limit(self):
+        root = tempfile.mkdtemp()
+        try:
+            seriesly = LocalSeriesly(root, max_open_files=10)
+            for i in range(5):
+                seriesly.create_db('ns_server{}'.format(i))
+            for ts in range(1000, 4000, 1000):
+                for db in seriesly.list_dbs():
+                    seriesly[db].append_docs([ts, ts + 500],
+                                             [{'ops': 1, 'cmd_get': 2}] * 2)
+                self.assertEqual(len(seriesly.writers), 2)  # 4 files each
+            seriesly.close()
+
+            for db in seriesly.list_dbs():
+                data = seriesly[db].query({'ptr': ['/ops', '/cmd_get'],
+                                           'reducer': ['count', 'sum'],
+                                           'group': 10 ** 12})
+                self.assertEqual(data, {'0': [6, 12]})
+        finally:
+            shutil.rmtree(root)
+
+    def test_replay_after_outage(self):
+        class FlakySeriesly(LocalSeriesly):
+
+            available = False
+
+            def list_dbs(self):
+                if not self.available:
+                    raise IOError('Connection refused')
+                return super(FlakySeriesly, self).list_dbs()
+
+        root = tempfile.mkdtemp()
+        try:
+            spill_path = os.path.join(root, 'spill')
+            seriesly = FlakySeriesly(os.path.join(root, 'stats'))
+            store = BufferedStore(seriesly, lambda **kwargs: 'atop',
+                                  spill_path=spill_path, flush_interval=60)
+            store.append({'cpu': 1})
+            store.flush()
+            self.assertEqual(store.stats['spilled'], 1)
+
+            seriesly.available = True
+            store.close()  # Nothing left in the buffer
+            seriesly.close()
+
+            self.assertEqual(os.listdir(spill_path), [])
+            data = seriesly['atop'].query({'ptr': '/cpu', 'reducer': 'sum',
+                                           'group': 10 ** 12})
+            self.assertEqual(data.values(), [[1]])
+        finally:
+            shutil.rmtree(root)
+
+    def test_replay_orphaned_spill_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            spill_path = os.path.join(root, 'spill')
+            os.makedirs(spill_path)
+            with open(os.path.join(spill_path, '4194305.json'), 'w') as fh:
+                for ts in range(1000, 251000, 1000):
+                    fh.write(json.dumps(['ns_server', ts, {'ops': 1}]) + '\n')
+
+            seriesly = LocalSeriesly(os.path.join(root, 'stats'))
+            store = BufferedStore(seriesly, lambda **kwargs: 'atop',
+                                  spill_path=spill_path, batch_size=100)
+            store.append({'cpu': 1})
+            store.close()
+            seriesly.close()
+
+            self.assertEqual(os.listdir(spill_path), [])
+            data = seriesly['ns_server'].query({'ptr': '/ops',
+                                                'reducer': 'count',
+                                                'group': 10 ** 12})
+            self.assertEqual(data, {'0': [250]})
+        finally:
+            shutil.rmtree(root)
+
+
+class TimeSeriesTest(TestCase):
+
+    def test_steady_state(self):
+        timestamps = np.arange(600) * 1000
+        values = np.random.RandomState(0).normal(10000, 100, 600)
+        values[:60] = np.linspace(0, 10000, 60)  # Ramp-up
+        values[-30:] = 0  # Tail
+
+        ts_from, ts_to = steady_state(timestamps, values, threshold=0.05)
+        self.assertTrue(50000 <= ts_from <= 70000)
+        self.assertTrue(560000 <= ts_to < 570000)
+
+    def test_not_enough_data(self):
+        self.assertIsNone(steady_state(range(10), range(10), window=30))
+
+    def test_counter_rate(self):
+        timestamps = [3000, 1000, 2000, 4000, 5000, 6000, 8000]
+        values = [30, 10, 20, np.nan, 50, 5, 25]  # Reset after 5000
+        timestamps, rates = counter_rate(timestamps, values)
+        self.assertEqual(timestamps.tolist(), range(2000, 9000, 1000))
+        self.assertEqual(rates.tolist(), [10, 10, 10, 10, 5, 10, 10])
+
+    def test_align(self):
+        timestamps, values = align([
+            (np.array([0, 5000, 10000]), [1, 2, 3]),
+            (np.array([5000, 10000, 15000]), [20, np.nan, 40]),
+        ])
+        self.assertEqual(timestamps.tolist(), [5000])
+        self.assertEqual(values.tolist(), [[2], [20]])
+
+    def test_change_points(self):
+        random = np.random.RandomState(0)
+        values = np.concatenate((
+            100 + 5 * random.randn(200),  # Before rebalance
+            60 + 5 * random.randn(100),  # Rebalance
+            100 + 5 * random.randn(200),  # Recovered
+        ))
+        points = change_points(values)
+        self.assertEqual(points, [200, 300])
+        levels = np.unique(np.round(fit_segments(values, points), -1))
+        self.assertEqual(levels.tolist(), [60, 100])
+
+        self.assertEqual(change_points(random.randn(1000)), [])
+
+    def test_resample(self):
+        timestamps = [300, 1200, 2700, 5100]
+        values = [1, 2, 4, 8]
+        grid, previous = resample(timestamps, values, method='previous')
+        self.assertEqual(grid.tolist(), [1000, 2000, 3000, 4000, 5000])
+        self.assertEqual(previous.tolist(), [1, 2, 4, 4, 4])
+        _, linear = resample(timestamps, values, method='linear')
+        self.assertAlmostEqual(linear[2], 4.5)
+
+        resampler = Resampler(method='sum')
+        resampler.update(timestamps[:2] + [1900], values[:2] + [3])
+        resampler.update(timestamps[2:], values[2:])
+        grid, sums = resampler.result()
+        self.assertEqual(grid.tolist(), range(0, 6000, 1000))
+        self.assertEqual(sums[:3].tolist(), [1, 5, 4])
+        self.assertTrue(np.isnan(sums[3:5]).all())
+
+    def test_resample_chunks(self):
+        random = np.random.RandomState(0)
+        timestamps = np.cumsum(random.randint(1, 3000, 1000))
+        values = random.rand(1000)
+        for method in Resampler.METHODS:
+            expected = resample(timestamps, values, method=method)
+            resampler = Resampler(method=method)
+            for chunk in range(0, 1000, 7):
+                resampler.update(timestamps[chunk:chunk + 7],
+                                 values[chunk:chunk + 7])
+            for a, b in zip(expected, resampler.result()):
+                np.testing.assert_allclose(a, b)
+
+
+class BootstrapTest(TestCase):
+
+    def test_confidence_intervals(self):
+        random = np.random.RandomState(0)
+        samples = random.lognormal(mean=0.5, sigma=1.0, size=100000)
+        bootstrap = BlockBootstrap(samples, resamples=200, seed=0)
+
+        low, high = bootstrap.mean()
+        self.assertTrue(low <= samples.mean() <= high)
+
+        low, high = bootstrap.percentile(95)
+        self.assertTrue(low <= np.percentile(samples, 95) <= high)
+        self.assertTrue(high - low < 0.1 * np.percentile(samples, 95))
+
+
+class ListStore(object):
+
+    def __init__(self):
+        self.docs = []
+        self.servers = []
+        self.flushed = 0
+
+    def append(self, data, **kwargs):
+        self.docs.append((kwargs.get('collector'), time.time(), data))
+        self.servers.append(kwargs.get('server'))
+
+    def flush(self):
+        self.flushed = len(self.docs)
+
+
+class Collector(object):
+
+    def __init__(self, store, interval, cluster='east', duration=0):
+        self.store = store
+        self.interval = interval
+        self.cluster = cluster
+        self.duration = duration
+
+    def sample(self):
+        time.sleep(self.duration)
+        self.store.append({'ops': 1}, collector='ns_server')
+
+    def sample_times(self):
+        return [ts for collector, ts, _ in self.store.docs
+                if collector == 'ns_server']
+
+
+def run_scheduler(scheduler, duration, **kwargs):
+    stop_event = Event()
+    Timer(duration, stop_event.set).start()
+    return scheduler.run(stop_event, **kwargs)
+
+
+class AdaptiveSamplingTest(TestCase):
+
+    def test_boost_and_budget(self):
+        adaptive = AdaptiveSampling(budget=100)
+        self.assertEqual(adaptive.interval(5, 0), 5)
+        self.assertEqual(adaptive.interval(5, 50), 10)
+        self.assertEqual(adaptive.interval(5, 75), 20)
+        self.assertIsNone(adaptive.interval(5, 100))
+
+        adaptive.boost()
+        self.assertEqual(adaptive.interval(5, 0), 1)
+
+    def test_trigger(self):
+        trigger = Trigger()
+        random = np.random.RandomState(0)
+        for value in random.normal(100, 5, 100):
+            self.assertFalse(trigger({'queue': value}))
+        self.assertTrue(trigger({'queue': 1000}))
+        self.assertTrue(trigger({'queue': 100, 'rebalance': 1}))
+
+    def test_trigger_warmup(self):
+        trigger = Trigger()
+        for i in range(Trigger.WARMUP):
+            doc = {'queue': 100 * (i % 2 + 1), 'state': 'warmup',
+                   'rebalance': bool(i % 2)}
+            if i == Trigger.WARMUP - 1:
+                doc['tasks'] = 1  # New field during warm-up
+            self.assertFalse(trigger(doc))
+        self.assertFalse(trigger({'queue': 150, 'state': 'running',
+                                  'rebalance': True, 'status': 'ok'}))
+        self.assertTrue(trigger({'queue': 150, 'compaction': 1}))
+
+    def test_over_budget(self):
+        store = ListStore()
+        scheduler = CollectorScheduler([Collector(store, interval=0.01)],
+                                       adaptive=AdaptiveSampling(budget=4),
+                                       report_interval=0.1)
+        stats = run_scheduler(scheduler, 0.5)['Collectoreast']
+
+        self.assertEqual(stats['samples'], 4)
+        self.assertGreater(stats['over_budget'], 0)
+        reported = sum(doc.get('over_budget', 0)
+                       for collector, _, doc in store.docs
+                       if collector == 'cbagent_self')
+        self.assertGreater(reported, 0)
+
+    def test_collector_names(self):
+        class Latency(object):
+
+            def __init__(self, cluster):
+                self.cluster = cluster
+
+        groups = [[Latency('c1')], [Latency('c1'), Latency('c2')]]
+        names = collector_names(sum(groups, []))
+        self.assertEqual(names, ['Latency0', 'Latency1', 'Latency'])
+
+
+class SchedulerTest(TestCase):
+
+    def test_deadlines(self):
+        fast = Collector(ListStore(), interval=0.05)
+        slow = Collector(ListStore(), interval=0.1)
+        started = time.time()
+        stats = run_scheduler(CollectorScheduler([fast, slow]), 1.0)
+
+        for collector, name in ((fast, 'Collector0east'),
+                                (slow, 'Collector1east')):
+            times = np.array(collector.sample_times()) - started
+            expected = np.arange(times.size) * collector.interval
+            self.assertAlmostEqual(times.size, 1 / collector.interval,
+                                   delta=1)
+            self.assertLess(np.abs(times - expected).max(), 0.02)  # No drift
+            self.assertEqual(stats[name]['samples'], times.size)
+            self.assertEqual(stats[name]['dropped'], 0)
+
+    def test_busy_collector(self):
+        fast = Collector(ListStore(), interval=0.05)
+        busy = Collector(ListStore(), interval=0.05, duration=0.22)
+        stats = run_scheduler(CollectorScheduler([fast, busy]), 1.0)
+
+        self.assertAlmostEqual(len(fast.sample_times()), 20, delta=1)
+        self.assertAlmostEqual(stats['Collector1east']['samples'], 5,
+                               delta=1)
+        self.assertGreater(stats['Collector1east']['dropped'], 10)
+
+    def test_stop_drains(self):
+        store = ListStore()
+        slow = Collector(store, interval=1, duration=0.3)
+        stats = run_scheduler(CollectorScheduler([slow]), 0.1)['Collectoreast']
+
+        self.assertEqual(len(slow.sample_times()), 1)  # Completed and stored
+        self.assertEqual(store.flushed, 1)
+        self.assertEqual(stats['samples'], 1)
+        self.assertEqual(stats['dropped'], 0)
+
+    def test_pause_resume(self):
+        collector = Collector(ListStore(), interval=0.05)
+        running = Event()
+        running.set()
+        paused = []
+        Timer(0.5, running.clear).start()
+        Timer(1.5, running.set).start()
+        run_scheduler(CollectorScheduler([collector]), 2.5, running=running,
+                      on_pause=paused.append)
+
+        self.assertEqual(len(paused), 1)
+        self.assertAlmostEqual(paused[0]['Collectoreast']['samples'], 10,
+                               delta=2)
+        times = np.array(collector.sample_times())
+        gaps = np.diff(times)
+        self.assertGreater(gaps.max(), 0.8)  # No samples while paused
+        self.assertEqual((gaps > 0.2).sum(), 1)
+        resumed = times[gaps.argmax() + 1:]
+        self.assertAlmostEqual(resumed.size, 20, delta=3)
+
+    def test_unique_names(self):
+        store = ListStore()
+        collectors = [Collector(store, interval=0.05) for _ in range(4)]
+        names = collector_names(collectors)
+        schedulers = [
+            CollectorScheduler(collectors[:2], names=names[:2],
+                               report_interval=0.1),
+            CollectorScheduler(collectors[2:], names=names[2:],
+                               report_interval=0.1),
+        ]
+        threads = [Thread(target=run_scheduler, args=(scheduler, 0.5))
+                   for scheduler in schedulers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        servers = {server for (collector, _, _), server
+                   in zip(store.docs, store.servers)
+                   if collector == 'cbagent_self'}
+        self.assertEqual(servers, {'Collector0', 'Collector1', 'Collector2',
+                                   'Collector3'})
+
+
+class MetricRegistryTest(TestCase):
+
+    def test_definitions(self):
+        for name, metric in METRICS.items():
+            self.assertEqual(name, '{}_{}'.format(metric.reducer, metric.field))
+            self.assertIn(metric.scope, ('bucket', 'first_bucket', 'server',
+                                         'initial_server'))
+            self.assertIn(metric.aggregate, AGGREGATES)
+            self.assertIn(metric.unit, UNITS)
+
+
+class RecalcTest(TestCase):
+
+    CLUSTER = 'local_400-1_abc'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cluster_spec = ClusterSpec()
+        self.cluster_spec.parse('clusters/cluster_run_1.spec')
+        self.test_config = TestConfig()
+        self.test_config.parse('tests/query_lat_20M.test',
+                               override=[('stats', 'store', 'local')])
+
+        seriesly = LocalSeriesly(os.path.join(self.root, 'stats'))
+        for collector, field, values in (
+            ('ns_server', 'cpu_utilization_rate', [40, 60] * 50),
+            ('spring_latency', 'latency_get', range(1, 101)),
+        ):
+            db = '{}{}bucket-1'.format(collector, self.CLUSTER)
+            seriesly.create_db(db)
+            seriesly[db].append_docs(range(1000, 101000, 1000),
+                                     [{field: value} for value in values])
+        seriesly.close()
+        self.seriesly = seriesly
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def calc_metrics(self, seriesly, manifests):
+        run = ArchivedRun(self.cluster_spec, self.test_config, manifests)
+        metric_helper = MetricHelper(run)
+        metric_helper.seriesly = seriesly
+        return (metric_helper.calc_cpu_utilization()[0],
+                metric_helper.calc_kv_latency('get', 95)[0])
+
+    def test_local_store_and_archive(self):
+        manifests = [{'cluster': self.CLUSTER, 'build': '4.0.0-1'}]
+        self.assertEqual(self.calc_metrics(self.seriesly, manifests),
+                         (50, 95))
+
+        archive = os.path.join(self.root, 'snapshots')
+        SnapshotArchiver(self.seriesly, archive).archive(
+            'access', self.CLUSTER, 0, 10 ** 6, phase='access',
+            build='4.0.0-1',
+        )
+        manifests = load_manifests(archive, 'access')
+        seriesly = ArchiveSeriesly([m['path'] for m in manifests])
+        self.assertEqual(self.calc_metrics(seriesly, manifests), (50, 95))
+
+    def test_parse_call(self):
+        self.assertEqual(parse_call("calc_kv_latency('get', percentile=95)"),
+                         ('calc_kv_latency', ['get'], {'percentile': 95}))
+        self.assertEqual(parse_call('calc_cpu_utilization'),
+                         ('calc_cpu_utilization', [], {}))
+        self.assertRaises(SystemExit, parse_call,  # Not a literal
+                          "calc_kv_latency(__import__('os'))")